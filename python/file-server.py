@@ -1,24 +1,491 @@
 #!/usr/bin/env python3
 import os
 import sys
+import argparse
+import fnmatch
+import gzip
+import hashlib
+import json
+import mimetypes
+import re
+import secrets
+import shutil
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from bisect import bisect_left
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesHeaderParser
+from email.utils import parsedate_to_datetime
 from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, quote, urlencode
 from pathlib import Path
 import html
 import base64
 
+# Codifiche opzionali: usate solo se i moduli sono installati
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MAX_CONNECTIONS = 64
+KEEPALIVE_TIMEOUT = 30
+# Oltre questo numero di intervalli l'header Range viene ignorato (risposta 200)
+MAX_RANGES = 64
+# Upload: dimensione dei blocchi letti dal socket e limite degli header di ogni parte
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+MAX_PART_HEADERS = 16 * 1024
+# Sottodirectory dello storage per i file in arrivo (stesso filesystem: rename atomico)
+INCOMING_DIR = ".incoming"
+# Sottodirectory dello storage con le varianti compresse dei file
+CACHE_DIR = ".cache"
+# Archivio content-addressed opzionale (--dedup) e attesa prima di rimuovere gli oggetti orfani
+OBJECTS_DIR = ".objects"
+GC_DELAY = 5
+# Upload a blocchi: dimensione predefinita e limiti dei blocchi
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024 * 1024
+MAX_CHUNKS = 1_000_000
+UPLOAD_ID_RE = re.compile(r"[0-9a-f]{32}")
+SHA256_RE = re.compile(r"[0-9a-fA-F]{64}")
+# Metodi il cui corpo resta nel socket se la richiesta viene rifiutata
+BODY_METHODS = ("POST", "PUT")
+# Indice della directory: file per pagina HTML e ordinamenti disponibili
+INDEX_PAGE_SIZE = 200
+SORT_KEYS = ("name", "size", "mtime")
+# Un mtime della directory così recente rispetto alla scansione potrebbe non
+# cambiare per modifiche successive (granularità dei timestamp): si riscansiona
+RACY_WINDOW_NS = 2_000_000_000
+
+FileEntry = namedtuple("FileEntry", "name size mtime")
+
+# Compressione dei download: solo file testuali tra queste dimensioni
+MIN_COMPRESS_SIZE = 1024
+MAX_COMPRESS_SIZE = 4 * 1024 * 1024 * 1024
+# Una variante compressa che non risparmia almeno il 10% non viene usata
+MIN_COMPRESS_RATIO = 0.9
+# Lock condivisi tra le varianti compresse (scelti con l'hash del percorso),
+# tenuti solo per sostituire il file in cache
+COMPRESS_LOCK_STRIPES = 64
+COMPRESSIBLE_TYPES = ("application/json", "application/xml", "application/javascript",
+                      "application/x-ndjson", "application/x-yaml", "application/x-sh",
+                      "image/svg+xml")
+COMPRESSIBLE_EXTENSIONS = (".log", ".csv", ".tsv", ".md", ".yaml", ".yml", ".ini", ".conf",
+                           ".cfg", ".toml", ".jsonl", ".ndjson", ".sql", ".out", ".err")
+
+# Archivi generati al volo: formato -> Content-Type
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar": "application/x-tar",
+    "tar.gz": "application/gzip",
+}
+if zstandard is not None:
+    ARCHIVE_FORMATS["tar.zst"] = "application/zstd"
+# Dimensione dei chunk HTTP negli archivi e limite dei corpi JSON delle richieste batch
+CHUNK_WRITE_SIZE = 256 * 1024
+MAX_JSON_BODY = 16 * 1024 * 1024
+
+
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB", "TB"):
+        if size < 1024 or unit == "TB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def safe_filename(name):
+    """Nome file senza percorso, None se non utilizzabile nello storage"""
+    name = os.path.basename(name or "")
+    if name in ("", ".", "..", INCOMING_DIR, CACHE_DIR, OBJECTS_DIR):
+        return None
+    return name
+
+
+# --- Compressione dei download ---
+def compress_gzip(src, dst):
+    with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=6, mtime=0) as out:
+        shutil.copyfileobj(src, out, UPLOAD_BLOCK_SIZE)
+
+
+def compress_zstd(src, dst):
+    zstandard.ZstdCompressor(level=3).copy_stream(src, dst, read_size=UPLOAD_BLOCK_SIZE)
+
+
+def compress_brotli(src, dst):
+    compressor = brotli.Compressor(quality=5)
+    while block := src.read(UPLOAD_BLOCK_SIZE):
+        dst.write(compressor.process(block))
+    dst.write(compressor.finish())
+
+
+# Codifiche disponibili in ordine di preferenza: nome -> (suffisso in cache, funzione)
+ENCODINGS = {}
+if zstandard is not None:
+    ENCODINGS["zstd"] = (".zst", compress_zstd)
+if brotli is not None:
+    ENCODINGS["br"] = (".br", compress_brotli)
+ENCODINGS["gzip"] = (".gz", compress_gzip)
+
+
+def is_compressible(name, size):
+    if not MIN_COMPRESS_SIZE <= size <= MAX_COMPRESS_SIZE:
+        return False
+    if name.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+        return True
+    content_type, encoding = mimetypes.guess_type(name)
+    if encoding is not None or content_type is None:
+        return False
+    return content_type.startswith("text/") or content_type in COMPRESSIBLE_TYPES
+
+
+def negotiate_encoding(header):
+    """Sceglie la codifica con q più alto tra quelle accettate e disponibili (None = identity)"""
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            accepted[name.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def etag_matches(header, etag):
+    """Confronto debole tra If-None-Match e l'ETag della risposta"""
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def file_etag(st):
+    """ETag forte ricavato da dimensione e mtime del file"""
+    return f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def parse_range(header, size):
+    """Interpreta un header "Range: bytes=..." e restituisce [(inizio, fine)] con fine inclusa.
+
+    None se l'header va ignorato (sintassi non valida o troppi intervalli),
+    lista vuota se nessun intervallo è soddisfacibile (416).
+    Gli intervalli sovrapposti o adiacenti vengono uniti.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if first:
+                start = int(first)
+                if last.strip():
+                    end = int(last)
+                    if end < start:
+                        return None
+                else:
+                    end = size - 1
+            else:
+                # Suffisso "-N": gli ultimi N byte
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, end = max(0, size - length), size - 1
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size - 1)))
+        if len(ranges) > MAX_RANGES:
+            return None
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ChunkedWriter:
+    """File in sola scrittura che invia i dati con Transfer-Encoding: chunked.
+
+    Accumula le scritture piccole (header di zip/tar) in chunk da
+    CHUNK_WRITE_SIZE byte; close() invia il chunk finale vuoto.
+    """
+
+    def __init__(self, wfile, chunk_size=CHUNK_WRITE_SIZE):
+        self.wfile = wfile
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if self.buffer:
+            self.wfile.write(b"%x\r\n" % len(self.buffer) + self.buffer + b"\r\n")
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class HashingWriter:
+    """Calcola lo sha256 dei dati mentre li passa a write"""
+
+    def __init__(self, write):
+        self.digest = hashlib.sha256()
+        self.target = write
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.target(data)
+
+
+class ObjectStore:
+    """Archivio content-addressed: ogni contenuto è salvato una sola volta in .objects/ab/abcd...
+
+    I nomi nello storage sono hardlink all'oggetto, quindi download, Range e
+    indice funzionano senza modifiche. Nomi con lo stesso contenuto
+    condividono anche mtime e permessi: riusando un oggetto il suo mtime viene
+    aggiornato, così il nome appena scritto non risulta più vecchio. Gli oggetti rimasti senza nomi
+    (st_nlink == 1) vengono rimossi da una pulizia differita.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(exist_ok=True)
+        self.lock = threading.Lock()
+        self.gc_timer = None
+
+    def path(self, digest):
+        return self.directory / digest[:2] / digest
+
+    def lookup(self, digest):
+        """stat dell'oggetto con questo sha256, None se non esiste"""
+        try:
+            return self.path(digest).stat()
+        except FileNotFoundError:
+            return None
+
+    def store(self, tmp_path, digest, destination):
+        """Pubblica tmp_path in destination riusando l'oggetto se il contenuto esiste già"""
+        obj = self.path(digest)
+        obj.parent.mkdir(exist_ok=True)
+        with self.lock:
+            try:
+                os.link(tmp_path, obj)
+            except FileExistsError:
+                # Contenuto già presente: il file temporaneo diventa un link all'oggetto
+                os.unlink(tmp_path)
+                os.link(obj, tmp_path)
+                os.utime(obj)
+            except OSError:
+                # Filesystem senza hardlink: il file viene salvato senza deduplicazione
+                pass
+        self.replace(tmp_path, destination)
+
+    def link(self, digest, destination, incoming):
+        """Crea destination come link a un oggetto esistente; False se l'oggetto non c'è"""
+        tmp_path = Path(incoming) / f"{secrets.token_hex(16)}.link"
+        with self.lock:
+            try:
+                os.link(self.path(digest), tmp_path)
+            except FileNotFoundError:
+                return False
+            os.utime(tmp_path)
+        self.replace(tmp_path, destination)
+        return True
+
+    def replace(self, tmp_path, destination):
+        # Se destination era un altro contenuto, il suo oggetto potrebbe restare orfano
+        overwritten = os.path.exists(destination)
+        os.replace(tmp_path, destination)
+        if overwritten:
+            self.schedule_gc()
+
+    def schedule_gc(self):
+        """Pianifica una pulizia degli oggetti orfani (una sola alla volta)"""
+        with self.lock:
+            if self.gc_timer is None:
+                self.gc_timer = threading.Timer(GC_DELAY, self.collect_garbage)
+                self.gc_timer.daemon = True
+                self.gc_timer.start()
+
+    def collect_garbage(self):
+        with self.lock:
+            self.gc_timer = None
+            for prefix in os.scandir(self.directory):
+                if not prefix.is_dir():
+                    continue
+                for entry in os.scandir(prefix.path):
+                    try:
+                        if entry.stat().st_nlink == 1:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        continue
+
+
+class DirectoryIndex:
+    """Elenco in memoria dei file dello storage con dimensione e mtime.
+
+    La directory viene riletta solo quando cambia il suo mtime (o dopo
+    invalidate()): le altre richieste costano una sola stat della directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.mtime_ns = None
+        self.racy = True
+        # Snapshot immutabile: (voci ordinate per nome, nomi, viste ordinate per altre chiavi)
+        self.snapshot = ([], [], {})
+
+    def invalidate(self):
+        self.mtime_ns = None
+
+    def is_current(self, mtime_ns):
+        return mtime_ns == self.mtime_ns and not self.racy
+
+    def refresh(self):
+        if self.is_current(os.stat(self.directory).st_mtime_ns):
+            return self.snapshot
+        with self.lock:
+            mtime_ns = os.stat(self.directory).st_mtime_ns
+            if self.is_current(mtime_ns):
+                return self.snapshot
+            scan_started = time.time_ns()
+            entries = []
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            st = entry.stat()
+                            entries.append(FileEntry(entry.name, st.st_size, st.st_mtime))
+                    except OSError:
+                        # File rimosso durante la scansione
+                        continue
+            entries.sort(key=lambda e: e.name)
+            self.snapshot = (entries, [e.name for e in entries], {})
+            self.mtime_ns = mtime_ns
+            self.racy = scan_started - mtime_ns < RACY_WINDOW_NS
+            return self.snapshot
+
+    def query(self, prefix="", sort="name", reverse=False, offset=0, limit=None):
+        """Restituisce (totale, voci della pagina) filtrando per prefisso del nome"""
+        entries, names, views = self.refresh()
+        if prefix:
+            # Le voci sono ordinate per nome: il prefisso è un intervallo contiguo
+            low = bisect_left(names, prefix)
+            high = bisect_left(names, prefix + "\U0010ffff", low)
+            selected = entries[low:high]
+            if sort != "name":
+                selected = sorted(selected, key=lambda e: (getattr(e, sort), e.name))
+        elif sort == "name":
+            selected = entries
+        else:
+            selected = views.get(sort)
+            if selected is None:
+                selected = views[sort] = sorted(entries, key=lambda e: (getattr(e, sort), e.name))
+
+        total = len(selected)
+        if limit is None:
+            limit = total
+        if reverse:
+            end = max(0, total - offset)
+            page = selected[max(0, end - limit):end][::-1]
+        else:
+            page = selected[offset:offset + limit]
+        return total, page
+
+
 class FileServerHandler(BaseHTTPRequestHandler):
     storage_dir = "storage"
+    index = None
+    # ObjectStore se la deduplicazione è attiva (--dedup)
+    objects = None
     USERNAME = "admin"
     PASSWORD = "admin"
 
+    # HTTP/1.1: connessioni persistenti, ogni risposta deve avere Content-Length
+    protocol_version = "HTTP/1.1"
+    # Chiude le connessioni keep-alive inattive e libera il posto nel pool
+    timeout = KEEPALIVE_TIMEOUT
+    # Header e corpo sono scritti separatamente: senza TCP_NODELAY il secondo
+    # write attende l'ACK ritardato del client a ogni richiesta keep-alive
+    disable_nagle_algorithm = True
+
+    # Sessioni di upload a blocchi attive, condivise tra i thread
+    upload_sessions = {}
+    upload_lock = threading.Lock()
+    # Serializzano la pubblicazione delle varianti compresse; il numero di lock
+    # è fisso, quindi non cresce con i file serviti
+    compress_locks = [threading.Lock() for _ in range(COMPRESS_LOCK_STRIPES)]
+
+    def send_error(self, code, message=None, explain=None):
+        # Il corpo di un POST/PUT rifiutato resta nel socket: la connessione non è riutilizzabile
+        if self.command in BODY_METHODS:
+            self.close_connection = True
+        super().send_error(code, message, explain)
+
+    def send_json(self, data, status=200, location=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if location:
+            self.send_header("Location", location)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_redirect(self, location):
+        self.send_response(303)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
     # --- Autenticazione HTTP Basic ---
     def do_AUTHHEAD(self):
+        body = b'Autenticazione richiesta.'
+        if self.command in BODY_METHODS:
+            self.close_connection = True
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm="FileServer"')
         self.send_header('Content-type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(b'Autenticazione richiesta.')
+        self.wfile.write(body)
 
     def authenticate(self):
         auth_header = self.headers.get('Authorization')
@@ -43,32 +510,33 @@ class FileServerHandler(BaseHTTPRequestHandler):
         params = parse_qs(parsed.query)
 
         if parsed.path == "/":
-            return self.send_index_page()
+            return self.send_index_page(params)
 
         elif parsed.path == "/list":
-            files = [f.name for f in Path(self.storage_dir).glob("*") if f.is_file()]
-            data = "\n".join(files).encode()
-            self.send_response(200)
-            self.send_header("Content-Type", "text/plain")
-            self.send_header("Content-Length", str(len(data)))
-            self.end_headers()
-            self.wfile.write(data)
+            return self.send_list(params)
+
+        elif parsed.path.startswith("/objects/"):
+            return self.check_object(parsed.path[len("/objects/"):])
+
+        elif parsed.path.startswith("/uploads/"):
+            session = self.get_upload(parsed.path[len("/uploads/"):])
+            if session is None:
+                return self.send_error(404, "Sessione di upload non trovata")
+            self.send_json(session.status())
 
         elif parsed.path == "/download":
             filename = params.get("file", [None])[0]
             if not filename:
                 return self.send_error(400, "Parametro 'file' mancante. Usa ?file=nomefile")
             file_path = Path(self.storage_dir) / filename
-            if not file_path.exists():
+            if not file_path.is_file():
                 return self.send_error(404, "File non trovato")
-            self.send_response(200)
-            self.send_header("Content-Type", "application/octet-stream")
-            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
-            self.send_header("Content-Length", str(file_path.stat().st_size))
-            self.end_headers()
-            with open(file_path, "rb") as f:
-                while chunk := f.read(8192):
-                    self.wfile.write(chunk)
+            self.send_file(file_path, filename)
+
+        elif parsed.path == "/archive":
+            return self.send_archive(params.get("file", []), params.get("glob", []),
+                                     params.get("format", ["zip"])[0],
+                                     params.get("compress", ["0"])[0] not in ("0", "false", ""))
 
         elif parsed.path == "/delete":
             filename = params.get("file", [None])[0]
@@ -79,77 +547,672 @@ class FileServerHandler(BaseHTTPRequestHandler):
                 return self.send_error(404, "File non trovato")
             try:
                 file_path.unlink()
-                self.send_response(303)
-                self.send_header("Location", "/")
-                self.end_headers()
+                self.drop_compressed(file_path.name)
+                self.index.invalidate()
+                if self.objects is not None:
+                    self.objects.schedule_gc()
+                self.send_redirect("/")
             except Exception as e:
                 self.send_error(500, f"Errore durante la cancellazione: {e}")
 
         else:
             self.send_error(404, "Not found")
 
+    # --- Download con sendfile e richieste Range ---
+    def if_range_matches(self, etag, last_modified):
+        """True se manca If-Range o se il file non è cambiato rispetto al validatore del client"""
+        validator = self.headers.get("If-Range")
+        return validator is None or validator.strip() in (etag, last_modified)
+
+    def not_modified(self, etag, st):
+        """True se il client ha già questa versione (If-None-Match, altrimenti If-Modified-Since)"""
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since is None:
+            return False
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since is not None and since.timestamp() >= int(st.st_mtime)
+
+    def send_not_modified(self, etag, last_modified, vary=False):
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
+        self.end_headers()
+
+    def compressed_variant(self, f, file_path, st, encoding):
+        """Percorso della variante compressa in cache, creata se manca o è più vecchia del file.
+
+        La cache è valida se ha lo stesso mtime del file originale; None se la
+        compressione non fa risparmiare abbastanza o il file cambia mentre viene compresso.
+        """
+        suffix, compress = ENCODINGS[encoding]
+        cached = Path(self.storage_dir) / CACHE_DIR / (file_path.name + suffix)
+        try:
+            cached_st = cached.stat()
+        except FileNotFoundError:
+            cached_st = None
+        if cached_st is None or cached_st.st_mtime_ns != st.st_mtime_ns:
+            cached_st = self.build_variant(f, st, compress, cached)
+            if cached_st is None:
+                return None
+
+        if cached_st.st_size > st.st_size * MIN_COMPRESS_RATIO:
+            return None
+        return cached
+
+    def build_variant(self, f, st, compress, cached):
+        """Comprime il file già aperto in cached; None se è cambiato durante la compressione.
+
+        La compressione avviene senza lock, così le richieste per altri file non
+        la attendono: il lock copre solo il controllo e la rinomina finale.
+        """
+        cached.parent.mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cached.parent, suffix=".tmp")
+        try:
+            f.seek(0)
+            with os.fdopen(fd, "wb") as dst:
+                compress(f, dst)
+            current = os.fstat(f.fileno())
+            if (current.st_mtime_ns, current.st_size) != (st.st_mtime_ns, st.st_size):
+                # Il contenuto compresso non corrisponde più a ETag e mtime di st
+                Path(tmp_path).unlink()
+                return None
+            os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+            with self.compress_locks[hash(cached) % COMPRESS_LOCK_STRIPES]:
+                try:
+                    cached_st = cached.stat()
+                except FileNotFoundError:
+                    cached_st = None
+                if cached_st is not None and cached_st.st_mtime_ns == st.st_mtime_ns:
+                    # Un'altra richiesta l'ha già creata nel frattempo
+                    Path(tmp_path).unlink()
+                    return cached_st
+                os.replace(tmp_path, cached)
+                return cached.stat()
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def drop_compressed(self, name):
+        for suffix, _ in ENCODINGS.values():
+            (Path(self.storage_dir) / CACHE_DIR / (name + suffix)).unlink(missing_ok=True)
+
+    def send_file(self, file_path, filename):
+        """Invia il file intero (200), un intervallo (206) o più intervalli (206 multipart/byteranges).
+
+        Risponde 304 se il client ha già il file e, senza Range, usa una variante
+        compressa se il client la accetta e il file è testuale.
+        """
+        with open(file_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            etag = file_etag(st)
+            last_modified = self.date_time_string(st.st_mtime)
+
+            compressible = is_compressible(filename, size)
+            encoding = None
+            if compressible and not self.headers.get("Range"):
+                encoding = negotiate_encoding(self.headers.get("Accept-Encoding", ""))
+            if encoding is not None:
+                # Ogni codifica è una rappresentazione diversa: ETag distinto
+                encoded_etag = f'{etag[:-1]}-{encoding}"'
+                if self.not_modified(encoded_etag, st):
+                    return self.send_not_modified(encoded_etag, last_modified, vary=True)
+                cached = self.compressed_variant(f, file_path, st, encoding)
+                if cached is not None:
+                    return self.send_encoded(cached, filename, encoding, encoded_etag, last_modified)
+            if self.not_modified(etag, st):
+                return self.send_not_modified(etag, last_modified, vary=compressible)
+
+            ranges = None
+            range_header = self.headers.get("Range")
+            if range_header and self.if_range_matches(etag, last_modified):
+                ranges = parse_range(range_header, size)
+
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(206 if ranges else 200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            if compressible:
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+
+            try:
+                if not ranges:
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(size))
+                    self.end_headers()
+                    self.send_file_range(f, 0, size)
+                elif len(ranges) == 1:
+                    start, end = ranges[0]
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+                    self.send_header("Content-Length", str(end - start + 1))
+                    self.end_headers()
+                    self.send_file_range(f, start, end - start + 1)
+                else:
+                    boundary = secrets.token_hex(16)
+                    parts = [
+                        (f"\r\n--{boundary}\r\n"
+                         f"Content-Type: application/octet-stream\r\n"
+                         f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+                        for start, end in ranges
+                    ]
+                    closing = f"\r\n--{boundary}--\r\n".encode()
+                    length = sum(len(head) for head in parts) + len(closing)
+                    length += sum(end - start + 1 for start, end in ranges)
+                    self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+                    self.send_header("Content-Length", str(length))
+                    self.end_headers()
+                    for head, (start, end) in zip(parts, ranges):
+                        self.wfile.write(head)
+                        self.send_file_range(f, start, end - start + 1)
+                    self.wfile.write(closing)
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                # Il client ha interrotto il download (es. per riprenderlo più tardi)
+                self.close_connection = True
+
+    def send_encoded(self, cached, filename, encoding, etag, last_modified):
+        """Invia la variante compressa in cache con Content-Encoding"""
+        with open(cached, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Encoding", encoding)
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Content-Disposition", f'attachment; filename="{filename}"')
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            try:
+                self.send_file_range(f, 0, size)
+            except (BrokenPipeError, ConnectionResetError, TimeoutError):
+                self.close_connection = True
+
+    def send_file_range(self, f, offset, count):
+        """Copia count byte del file nel socket; usa sendfile (zero-copy) quando disponibile"""
+        sent = self.connection.sendfile(f, offset, count)
+        if sent < count:
+            # File accorciato durante l'invio: Content-Length non più rispettabile
+            self.close_connection = True
+
     # --- Gestione POST per upload ---
+    def receive_files(self, reader):
+        """Salva ogni parte con filename in un file temporaneo, rinominato quando la parte è completa"""
+        incoming = Path(self.storage_dir) / INCOMING_DIR
+        incoming.mkdir(exist_ok=True)
+        while reader.next_part():
+            headers = reader.read_part_headers()
+            filename = safe_filename(headers.get_filename())
+            if filename is None:
+                # Campo del form o input file vuoto: nulla da salvare
+                reader.copy_part(None)
+                continue
+            fd, tmp_path = tempfile.mkstemp(dir=incoming, suffix=".part")
+            # mkstemp crea file 0600: i file pubblicati devono restare leggibili come prima
+            os.fchmod(fd, 0o644)
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    if self.objects is None:
+                        reader.copy_part(out.write)
+                    else:
+                        # Hash calcolato durante lo streaming, senza rileggere il file
+                        writer = HashingWriter(out.write)
+                        reader.copy_part(writer.write)
+                if self.objects is None:
+                    os.replace(tmp_path, Path(self.storage_dir) / filename)
+                else:
+                    self.objects.store(tmp_path, writer.digest.hexdigest(), Path(self.storage_dir) / filename)
+            except BaseException:
+                Path(tmp_path).unlink(missing_ok=True)
+                raise
+            self.index.invalidate()
+
     def do_POST(self):
         if not self.authenticate():
             return
 
         parsed = urlparse(self.path)
+        if parsed.path == "/uploads":
+            return self.create_upload(parse_qs(parsed.query))
+        if parsed.path.startswith("/uploads/") and parsed.path.endswith("/finalize"):
+            return self.finalize_upload(parsed.path[len("/uploads/"):-len("/finalize")],
+                                        parse_qs(parsed.query))
+        if parsed.path.startswith("/objects/"):
+            return self.link_object(parsed.path[len("/objects/"):], parse_qs(parsed.query))
+        if parsed.path in ("/archive", "/batch/delete", "/batch/stat"):
+            try:
+                request = self.read_json_body()
+                names = self.json_names(request, "files")
+                patterns = self.json_names(request, "glob")
+            except ValueError as e:
+                return self.send_error(400, f"Corpo JSON non valido: {e}")
+            if parsed.path == "/archive":
+                return self.send_archive(names, patterns,
+                                         request.get("format", "zip"), bool(request.get("compress")))
+            if parsed.path == "/batch/delete":
+                return self.batch_delete(names)
+            return self.batch_stat(names, patterns)
         if parsed.path != "/upload":
             self.send_error(404, "Not found")
             return
 
-        ctype = self.headers.get("Content-Type", "")
-        if "multipart/form-data" not in ctype:
+        if self.headers.get_content_type() != "multipart/form-data":
             return self.send_error(400, "Upload non valido")
+        boundary = self.headers.get_boundary()
+        if not boundary:
+            return self.send_error(400, "Boundary multipart mancante")
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self.send_error(411, "Content-Length richiesto")
 
-        boundary = ctype.split("boundary=")[1]
-        remainbytes = int(self.headers['Content-length'])
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        if not boundary.encode() in line:
-            return self.send_error(400, "Malformed form data")
+        reader = MultipartReader(self.rfile, boundary.encode(), length)
+        try:
+            self.receive_files(reader)
+        except ValueError as e:
+            return self.send_error(400, f"Upload non valido: {e}")
+        except (ConnectionError, TimeoutError):
+            # Il client si è disconnesso: i file parziali sono già stati rimossi
+            self.close_connection = True
+            return
 
-        line = self.rfile.readline()
-        remainbytes -= len(line)
-        filename = line.decode().split('filename="')[1].split('"')[0]
-        filename = os.path.basename(filename)
+        # Consuma l'eventuale epilogo per poter riusare la connessione
+        reader.drain()
+        self.send_redirect("/")
 
-        # Salta header
-        while True:
-            line = self.rfile.readline()
-            remainbytes -= len(line)
-            if line.strip() == b'':
-                break
+    # --- Upload a blocchi riprendibile ---
+    # POST   /uploads?file=NOME&size=N[&chunk_size=C][&sha256=HEX]  crea la sessione
+    # PUT    /uploads/<id>/<indice>   invia il blocco (anche in parallelo)
+    # GET    /uploads/<id>            stato: blocchi mancanti da (re)inviare
+    # POST   /uploads/<id>/finalize[?sha256=HEX]  verifica il checksum e pubblica il file
+    # DELETE /uploads/<id>            annulla la sessione
+    def get_upload(self, upload_id):
+        """Sessione attiva o salvata su disco (sopravvive al riavvio del server)"""
+        if not UPLOAD_ID_RE.fullmatch(upload_id):
+            return None
+        with self.upload_lock:
+            session = self.upload_sessions.get(upload_id)
+            if session is None:
+                session = ChunkedUpload.load(Path(self.storage_dir) / INCOMING_DIR, upload_id)
+                if session is not None:
+                    self.upload_sessions[upload_id] = session
+            return session
 
-        outpath = Path(self.storage_dir) / filename
-        with open(outpath, 'wb') as out:
-            preline = self.rfile.readline()
-            remainbytes -= len(preline)
-            while remainbytes > 0:
-                line = self.rfile.readline()
-                remainbytes -= len(line)
-                if boundary.encode() in line:
-                    preline = preline.rstrip(b'\r\n')
-                    out.write(preline)
-                    break
-                else:
-                    out.write(preline)
-                    preline = line
+    def create_upload(self, params):
+        filename = safe_filename(params.get("file", [None])[0])
+        if filename is None:
+            return self.send_error(400, "Parametro 'file' mancante o non valido")
+        try:
+            size = int(params.get("size", [""])[0])
+            chunk_size = int(params.get("chunk_size", [DEFAULT_CHUNK_SIZE])[0])
+        except ValueError:
+            return self.send_error(400, "Parametri 'size' e 'chunk_size' devono essere interi")
+        sha256 = params.get("sha256", [None])[0]
+        if size < 0:
+            return self.send_error(400, "Parametro 'size' non può essere negativo")
+        if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+            return self.send_error(400, f"chunk_size deve essere tra {MIN_CHUNK_SIZE} e {MAX_CHUNK_SIZE}")
+        if -(-size // chunk_size) > MAX_CHUNKS:
+            return self.send_error(400, "Troppi blocchi: aumentare chunk_size")
+        if sha256 is not None and not SHA256_RE.fullmatch(sha256):
+            return self.send_error(400, "Checksum sha256 non valido")
 
-        self.send_response(303)
-        self.send_header("Location", "/")
+        incoming = Path(self.storage_dir) / INCOMING_DIR
+        incoming.mkdir(exist_ok=True)
+        try:
+            session = ChunkedUpload.create(incoming, filename, size, chunk_size, sha256)
+        except OSError as e:
+            return self.send_error(507, f"Impossibile allocare il file: {e}")
+        with self.upload_lock:
+            self.upload_sessions[session.id] = session
+        self.send_json(session.status(), 201, location=f"/uploads/{session.id}")
+
+    def do_PUT(self):
+        if not self.authenticate():
+            return
+
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) != 3 or parts[0] != "uploads":
+            return self.send_error(404, "Not found")
+        session = self.get_upload(parts[1])
+        if session is None:
+            return self.send_error(404, "Sessione di upload non trovata")
+        try:
+            index = int(parts[2])
+            offset, expected = session.chunk_range(index)
+        except ValueError:
+            return self.send_error(400, "Indice del blocco non valido")
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return self.send_error(411, "Content-Length richiesto")
+        if length != expected:
+            return self.send_error(400, f"Il blocco {index} deve essere di {expected} byte")
+        chunk_sha256 = self.headers.get("X-Chunk-SHA256")
+        if chunk_sha256 is not None and not SHA256_RE.fullmatch(chunk_sha256):
+            return self.send_error(400, "X-Chunk-SHA256 non valido")
+
+        try:
+            digest = session.write_chunk(self.rfile, offset, length, chunk_sha256 is not None)
+        except (ConnectionError, TimeoutError):
+            # Blocco incompleto: non viene segnato come ricevuto
+            self.close_connection = True
+            return
+        if digest is not None and digest != chunk_sha256.lower():
+            return self.send_error(422, f"Checksum del blocco {index} non corrispondente")
+        session.mark_received(index)
+        self.send_json({"chunk": index, "received": session.received_count(), "chunks": session.chunks})
+
+    def finalize_upload(self, upload_id, params):
+        session = self.get_upload(upload_id)
+        if session is None:
+            return self.send_error(404, "Sessione di upload non trovata")
+        sha256 = params.get("sha256", [session.sha256])[0]
+        if sha256 is None or not SHA256_RE.fullmatch(sha256):
+            return self.send_error(400, "Checksum sha256 mancante o non valido")
+        missing = session.missing()
+        if missing:
+            return self.send_json({"error": "blocchi mancanti", "missing": missing}, 409)
+        actual = session.checksum()
+        if actual != sha256.lower():
+            return self.send_json({"error": "checksum non corrispondente", "sha256": actual}, 422)
+        session.commit(Path(self.storage_dir) / session.name, self.objects, actual)
+        self.index.invalidate()
+        with self.upload_lock:
+            self.upload_sessions.pop(session.id, None)
+        self.send_json({"file": session.name, "size": session.size, "sha256": actual}, 201,
+                       location=f"/download?file={quote(session.name)}")
+
+    def do_DELETE(self):
+        if not self.authenticate():
+            return
+
+        parsed = urlparse(self.path)
+        if not parsed.path.startswith("/uploads/"):
+            return self.send_error(404, "Not found")
+        session = self.get_upload(parsed.path[len("/uploads/"):])
+        if session is None:
+            return self.send_error(404, "Sessione di upload non trovata")
+        with self.upload_lock:
+            self.upload_sessions.pop(session.id, None)
+        session.abort()
+        self.send_json({"aborted": session.id})
+
+    # --- Deduplicazione: verifica e riuso di un contenuto per hash ---
+    # GET  /objects/<sha256>              il contenuto è già presente?
+    # POST /objects/<sha256>?file=NOME    pubblica NOME senza upload se il contenuto esiste
+    def check_object(self, digest):
+        if self.objects is None:
+            return self.send_error(404, "Deduplicazione non attiva (avviare con --dedup)")
+        if not SHA256_RE.fullmatch(digest):
+            return self.send_error(400, "Checksum sha256 non valido")
+        st = self.objects.lookup(digest.lower())
+        if st is None:
+            return self.send_json({"sha256": digest.lower(), "exists": False}, 404)
+        self.send_json({"sha256": digest.lower(), "exists": True, "size": st.st_size})
+
+    def link_object(self, digest, params):
+        if self.objects is None:
+            return self.send_error(404, "Deduplicazione non attiva (avviare con --dedup)")
+        if not SHA256_RE.fullmatch(digest):
+            return self.send_error(400, "Checksum sha256 non valido")
+        filename = safe_filename(params.get("file", [None])[0])
+        if filename is None:
+            return self.send_error(400, "Parametro 'file' mancante o non valido")
+        incoming = Path(self.storage_dir) / INCOMING_DIR
+        incoming.mkdir(exist_ok=True)
+        if not self.objects.link(digest.lower(), Path(self.storage_dir) / filename, incoming):
+            return self.send_json({"sha256": digest.lower(), "exists": False}, 404)
+        self.drop_compressed(filename)
+        self.index.invalidate()
+        self.send_json({"file": filename, "sha256": digest.lower()}, 201,
+                       location=f"/download?file={quote(filename)}")
+
+    # --- Archivi e operazioni batch ---
+    # GET  /archive?file=a&file=b&glob=*.log&format=zip|tar|tar.gz[&compress=1]
+    # POST /archive        {"files": [...], "glob": [...], "format": "tar.gz"}
+    # POST /batch/delete   {"files": [...]}
+    # POST /batch/stat     {"files": [...], "glob": [...]}
+    def read_json_body(self):
+        """Legge e decodifica il corpo JSON della richiesta (un oggetto)"""
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            raise ValueError("Content-Length mancante")
+        if not 0 <= length <= MAX_JSON_BODY:
+            raise ValueError(f"corpo oltre {MAX_JSON_BODY} byte")
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not isinstance(request, dict):
+            raise ValueError("atteso un oggetto JSON")
+        return request
+
+    @staticmethod
+    def json_names(request, key):
+        """Valore di key nel corpo JSON come lista di stringhe (accetta anche una stringa sola)"""
+        value = request.get(key, [])
+        if isinstance(value, str):
+            return [value]
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise ValueError(f"'{key}' deve essere una stringa o una lista di stringhe")
+        return value
+
+    def select_files(self, names, patterns):
+        """Nomi richiesti esplicitamente più quelli dello storage che corrispondono ai glob"""
+        if isinstance(names, str):
+            names = [names]
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        selected = dict.fromkeys(str(name) for name in names)
+        if patterns:
+            _, all_files = self.index.query()
+            for pattern in patterns:
+                selected.update(dict.fromkeys(fnmatch.filter((f.name for f in all_files), str(pattern))))
+        return list(selected)
+
+    def send_archive(self, names, patterns, archive_format, compress):
+        """Invia uno zip o un tar costruito al volo, in streaming chunked e senza file temporanei"""
+        if archive_format not in ARCHIVE_FORMATS:
+            return self.send_error(400, f"Formato non supportato, usa uno tra: {', '.join(ARCHIVE_FORMATS)}")
+        selected = self.select_files(names, patterns)
+        if not selected:
+            return self.send_error(400, "Nessun file selezionato: usa file= o glob=")
+        paths = []
+        missing = []
+        for name in selected:
+            filename = safe_filename(name)
+            if filename is None or not (Path(self.storage_dir) / filename).is_file():
+                missing.append(name)
+            else:
+                paths.append((filename, Path(self.storage_dir) / filename))
+        if missing:
+            return self.send_json({"error": "file non trovati", "missing": missing}, 404)
+
+        self.send_response(200)
+        self.send_header("Content-Type", ARCHIVE_FORMATS[archive_format])
+        self.send_header("Content-Disposition", f'attachment; filename="archive.{archive_format}"')
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        out = ChunkedWriter(self.wfile)
+        try:
+            if archive_format == "zip":
+                self.write_zip(out, paths, compress)
+            else:
+                self.write_tar(out, paths, archive_format)
+            out.close()
+        except (OSError, tarfile.TarError) as e:
+            # Header già inviati: si chiude la connessione senza il chunk finale,
+            # così il client vede un archivio troncato e non uno valido ma incompleto
+            self.log_error("Archivio interrotto: %s", e)
+            self.close_connection = True
+
+    def write_zip(self, out, paths, compress):
+        compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with zipfile.ZipFile(out, "w", compression=compression) as archive:
+            for name, path in paths:
+                with open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    # Lo zip non rappresenta date precedenti al 1980
+                    info = zipfile.ZipInfo(name, time.localtime(max(st.st_mtime, 315532800))[:6])
+                    info.compress_type = compression
+                    info.external_attr = 0o644 << 16
+                    info.file_size = st.st_size
+                    with archive.open(info, "w", force_zip64=st.st_size >= zipfile.ZIP64_LIMIT) as dest:
+                        shutil.copyfileobj(f, dest, UPLOAD_BLOCK_SIZE)
+
+    def write_tar(self, out, paths, archive_format):
+        # La compressione avvolge lo stream: "w|gz" di tarfile userebbe sempre il livello 9
+        target = out
+        if archive_format == "tar.gz":
+            target = gzip.GzipFile(fileobj=out, mode="wb", compresslevel=6)
+        elif archive_format == "tar.zst":
+            target = zstandard.ZstdCompressor(level=3).stream_writer(out)
+        with tarfile.open(fileobj=target, mode="w|", bufsize=CHUNK_WRITE_SIZE) as archive:
+            for name, path in paths:
+                with open(path, "rb") as f:
+                    st = os.fstat(f.fileno())
+                    info = tarfile.TarInfo(name)
+                    info.size = st.st_size
+                    info.mtime = st.st_mtime
+                    info.mode = 0o644
+                    archive.addfile(info, f)
+        if archive_format == "tar.gz":
+            target.close()
+        elif archive_format == "tar.zst":
+            target.flush(zstandard.FLUSH_FRAME)
+
+    def batch_delete(self, names):
+        if isinstance(names, str):
+            names = [names]
+        deleted, missing, errors = [], [], {}
+        for name in map(str, names):
+            filename = safe_filename(name)
+            file_path = Path(self.storage_dir) / filename if filename else None
+            if file_path is None or not file_path.is_file():
+                missing.append(name)
+                continue
+            try:
+                file_path.unlink()
+                self.drop_compressed(filename)
+                deleted.append(name)
+            except OSError as e:
+                errors[name] = str(e)
+        if deleted:
+            self.index.invalidate()
+            if self.objects is not None:
+                self.objects.schedule_gc()
+        self.send_json({"deleted": deleted, "missing": missing, "errors": errors})
+
+    def batch_stat(self, names, patterns):
+        result = {}
+        for name in self.select_files(names, patterns):
+            filename = safe_filename(name)
+            try:
+                st = (Path(self.storage_dir) / filename).stat() if filename else None
+            except OSError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                result[name] = None
+            else:
+                result[name] = {"size": st.st_size, "mtime": st.st_mtime, "etag": file_etag(st)}
+        self.send_json({"files": result})
+
+    # --- Elenco file (indice in memoria) ---
+    def list_query(self, params):
+        """Legge prefix/sort/order/offset/limit; solleva ValueError se non validi"""
+        sort = params.get("sort", ["name"])[0]
+        order = params.get("order", ["asc"])[0]
+        if sort not in SORT_KEYS or order not in ("asc", "desc"):
+            raise ValueError(f"sort deve essere uno tra {', '.join(SORT_KEYS)} e order asc o desc")
+        offset = int(params.get("offset", [0])[0])
+        limit = params.get("limit", [None])[0]
+        limit = int(limit) if limit is not None else None
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError("offset e limit non possono essere negativi")
+        return {
+            "prefix": params.get("prefix", [""])[0],
+            "sort": sort,
+            "reverse": order == "desc",
+            "offset": offset,
+            "limit": limit,
+        }
+
+    def send_list(self, params):
+        """/list: nomi in testo semplice (o JSON con metadati con format=json), paginabili"""
+        try:
+            query = self.list_query(params)
+        except ValueError as e:
+            return self.send_error(400, f"Parametri non validi: {e}")
+        total, page = self.index.query(**query)
+
+        if params.get("format", ["text"])[0] == "json":
+            data = json.dumps({
+                "total": total,
+                "offset": query["offset"],
+                "files": [entry._asdict() for entry in page],
+            }).encode()
+            content_type = "application/json"
+        else:
+            data = "\n".join(entry.name for entry in page).encode()
+            content_type = "text/plain"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("X-Total-Count", str(total))
         self.end_headers()
+        self.wfile.write(data)
 
     # --- Pagina HTML principale ---
-    def send_index_page(self):
-        files = [f.name for f in Path(self.storage_dir).glob("*") if f.is_file()]
+    def send_index_page(self, params):
+        sort = params.get("sort", ["name"])[0]
+        order = params.get("order", ["asc"])[0]
+        prefix = params.get("prefix", [""])[0]
+        if sort not in SORT_KEYS:
+            sort = "name"
+        try:
+            page_number = max(1, int(params.get("page", [1])[0]))
+        except ValueError:
+            page_number = 1
+        total, files = self.index.query(prefix, sort, order == "desc",
+                                        (page_number - 1) * INDEX_PAGE_SIZE, INDEX_PAGE_SIZE)
+        pages = max(1, -(-total // INDEX_PAGE_SIZE))
+
+        def page_url(**changes):
+            query = {"sort": sort, "order": order, "prefix": prefix, "page": page_number, **changes}
+            return html.escape("/?" + urlencode({k: v for k, v in query.items() if v}))
+
         rows = "".join(
             f"<li>"
-            f"<a href='/download?file={html.escape(f)}'>{html.escape(f)}</a> "
-            f"<a href='/delete?file={html.escape(f)}' onclick='return confirm(\"Confermi cancellazione {html.escape(f)}?\");'>[Elimina]</a>"
+            f"<a href='/download?file={quote(f.name)}'>{html.escape(f.name)}</a> "
+            f"<small>{human_size(f.size)} · {time.strftime('%Y-%m-%d %H:%M', time.localtime(f.mtime))}</small> "
+            f"<a href='/delete?file={quote(f.name)}' onclick='return confirm({html.escape(json.dumps('Confermi cancellazione ' + f.name + '?'))});'>[Elimina]</a>"
             f"</li>"
             for f in files
         )
+        sort_links = " ".join(
+            f"<a href='{page_url(sort=key, order='desc' if key == sort and order == 'asc' else 'asc', page=1)}'>{key}</a>"
+            for key in SORT_KEYS
+        )
+        nav = f"Pagina {page_number} di {pages} ({total} file)"
+        if page_number > 1:
+            nav = f"<a href='{page_url(page=page_number - 1)}'>&laquo; Precedente</a> " + nav
+        if page_number < pages:
+            nav += f" <a href='{page_url(page=page_number + 1)}'>Successiva &raquo;</a>"
 
         html_content = f"""
         <!DOCTYPE html>
@@ -162,16 +1225,25 @@ class FileServerHandler(BaseHTTPRequestHandler):
                 input[type=file] {{ margin: 10px 0; }}
                 ul {{ list-style-type: none; padding: 0; }}
                 li {{ margin: 4px 0; }}
+                small {{ color: #666; }}
             </style>
         </head>
         <body>
             <h1>📁 File Server</h1>
             <form method="POST" enctype="multipart/form-data" action="/upload">
-                <input type="file" name="file" required>
+                <input type="file" name="file" multiple required>
                 <input type="submit" value="Carica">
             </form>
             <h2>File disponibili</h2>
+            <form method="GET" action="/">
+                <input type="text" name="prefix" value="{html.escape(prefix)}" placeholder="Filtra per prefisso">
+                <input type="hidden" name="sort" value="{html.escape(sort)}">
+                <input type="hidden" name="order" value="{html.escape(order)}">
+                <input type="submit" value="Filtra">
+            </form>
+            <p>Ordina per: {sort_links}</p>
             <ul>{rows if rows else "<li>Nessun file presente</li>"}</ul>
+            <p>{nav}</p>
         </body>
         </html>
         """
@@ -183,42 +1255,340 @@ class FileServerHandler(BaseHTTPRequestHandler):
         self.wfile.write(data)
 
 
+# --- Parser multipart/form-data a blocchi ---
+class MultipartReader:
+    """Legge un corpo multipart/form-data a blocchi di dimensione fissa.
+
+    Non usa readline: cerca il delimitatore "\\r\\n--boundary" nel buffer
+    e trattiene solo gli ultimi len(delimitatore) - 1 byte tra un blocco e il
+    successivo, così la memoria resta costante qualunque sia il contenuto.
+    """
+
+    def __init__(self, rfile, boundary, length, block_size=UPLOAD_BLOCK_SIZE):
+        self.rfile = rfile
+        self.remaining = length
+        self.block_size = block_size
+        self.delimiter = b"\r\n--" + boundary
+        # Il primo delimitatore apre il corpo senza CRLF iniziale
+        self.buffer = bytearray(b"\r\n")
+        self.started = False
+
+    def fill(self):
+        """Aggiunge al buffer il prossimo blocco del corpo; False se il corpo è finito"""
+        if self.remaining <= 0:
+            return False
+        chunk = self.rfile.read1(min(self.block_size, self.remaining))
+        if not chunk:
+            raise ConnectionError("connessione chiusa durante l'upload")
+        self.remaining -= len(chunk)
+        self.buffer += chunk
+        return True
+
+    def copy_part(self, write):
+        """Passa a write i dati fino al prossimo delimitatore (scartati se write è None)"""
+        keep = len(self.delimiter) - 1
+        while True:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                self.flush(write, index)
+                del self.buffer[:len(self.delimiter)]
+                return
+            # Un delimitatore può iniziare negli ultimi byte: li trattiene per il blocco successivo
+            if len(self.buffer) > keep:
+                self.flush(write, len(self.buffer) - keep)
+            if not self.fill():
+                raise ValueError("corpo multipart troncato")
+
+    def flush(self, write, count):
+        if write is not None and count:
+            with memoryview(self.buffer) as view:
+                write(view[:count])
+        del self.buffer[:count]
+
+    def ensure(self, count):
+        while len(self.buffer) < count:
+            if not self.fill():
+                raise ValueError("corpo multipart troncato")
+
+    def next_part(self):
+        """Si posiziona dopo il prossimo delimitatore; False se era quello di chiusura"""
+        if not self.started:
+            # Salta l'eventuale preambolo
+            self.copy_part(None)
+            self.started = True
+        self.ensure(2)
+        if self.buffer[:2] == b"--":
+            return False
+        # Resto della riga del delimitatore (eventuali spazi di padding e CRLF)
+        while (end := self.buffer.find(b"\r\n")) < 0:
+            if len(self.buffer) > MAX_PART_HEADERS or not self.fill():
+                raise ValueError("delimitatore multipart non valido")
+        del self.buffer[:end + 2]
+        return True
+
+    def read_part_headers(self):
+        """Legge gli header della parte corrente"""
+        if self.buffer[:2] == b"\r\n":
+            del self.buffer[:2]
+            return BytesHeaderParser().parsebytes(b"")
+        while (end := self.buffer.find(b"\r\n\r\n")) < 0:
+            if len(self.buffer) > MAX_PART_HEADERS:
+                raise ValueError("header della parte troppo lunghi")
+            if not self.fill():
+                raise ValueError("corpo multipart troncato")
+        raw = bytes(self.buffer[:end + 4])
+        del self.buffer[:end + 4]
+        return BytesHeaderParser().parsebytes(raw)
+
+    def drain(self):
+        """Scarta il resto del corpo (epilogo)"""
+        self.buffer.clear()
+        while self.remaining > 0:
+            chunk = self.rfile.read1(min(self.block_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+
+
+# --- Sessione di upload a blocchi ---
+class ChunkedUpload:
+    """Upload a blocchi: file preallocato in .incoming, blocchi scritti con pwrite.
+
+    Lo stato (blocchi ricevuti) è salvato accanto al file in <id>.json, così
+    un client può riprendere l'upload anche dopo un riavvio del server.
+    """
+
+    def __init__(self, directory, upload_id, name, size, chunk_size, sha256=None, received=None):
+        self.directory = Path(directory)
+        self.id = upload_id
+        self.name = name
+        self.size = size
+        self.chunk_size = chunk_size
+        self.sha256 = sha256.lower() if sha256 else None
+        self.chunks = -(-size // chunk_size)
+        # Un byte per blocco: 1 se ricevuto
+        self.received = bytearray(received or bytes(self.chunks))
+        self.lock = threading.Lock()
+
+    @property
+    def data_path(self):
+        return self.directory / f"{self.id}.upload"
+
+    @property
+    def state_path(self):
+        return self.directory / f"{self.id}.json"
+
+    @classmethod
+    def create(cls, directory, name, size, chunk_size, sha256=None):
+        session = cls(directory, secrets.token_hex(16), name, size, chunk_size, sha256)
+        fd = os.open(session.data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            if size and hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError:
+                    # Filesystem senza fallocate: file sparso della dimensione finale
+                    os.ftruncate(fd, size)
+            else:
+                os.ftruncate(fd, size)
+        except OSError:
+            os.close(fd)
+            session.data_path.unlink(missing_ok=True)
+            raise
+        os.close(fd)
+        session.save_state()
+        return session
+
+    @classmethod
+    def load(cls, directory, upload_id):
+        try:
+            state = json.loads((Path(directory) / f"{upload_id}.json").read_text())
+            return cls(directory, upload_id, state["name"], state["size"], state["chunk_size"],
+                       state.get("sha256"), bytes.fromhex(state["received"]))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save_state(self):
+        """Scrive lo stato in modo atomico (file temporaneo + rename)"""
+        state = {
+            "name": self.name,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "sha256": self.sha256,
+            "received": self.received.hex(),
+        }
+        tmp_path = self.state_path.with_suffix(".json.tmp")
+        tmp_path.write_text(json.dumps(state))
+        os.replace(tmp_path, self.state_path)
+
+    def chunk_range(self, index):
+        """(offset, lunghezza) del blocco; ValueError se l'indice è fuori intervallo"""
+        if not 0 <= index < self.chunks:
+            raise ValueError(index)
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def write_chunk(self, rfile, offset, length, with_digest=False):
+        """Copia length byte dal socket nel file a partire da offset; restituisce lo sha256 se richiesto"""
+        digest = hashlib.sha256() if with_digest else None
+        fd = os.open(self.data_path, os.O_WRONLY)
+        try:
+            while length > 0:
+                block = rfile.read1(min(UPLOAD_BLOCK_SIZE, length))
+                if not block:
+                    raise ConnectionError("connessione chiusa durante il blocco")
+                if digest is not None:
+                    digest.update(block)
+                view = memoryview(block)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    view = view[written:]
+                    offset += written
+                length -= len(block)
+        finally:
+            os.close(fd)
+        return digest.hexdigest() if digest is not None else None
+
+    def mark_received(self, index):
+        with self.lock:
+            if not self.received[index]:
+                self.received[index] = 1
+                self.save_state()
+
+    def received_count(self):
+        return self.received.count(1)
+
+    def missing(self):
+        return [index for index, done in enumerate(self.received) if not done]
+
+    def status(self):
+        return {
+            "id": self.id,
+            "file": self.name,
+            "size": self.size,
+            "chunk_size": self.chunk_size,
+            "chunks": self.chunks,
+            "received": self.received_count(),
+            "missing": self.missing(),
+        }
+
+    def checksum(self):
+        digest = hashlib.sha256()
+        with open(self.data_path, "rb") as f:
+            while block := f.read(UPLOAD_BLOCK_SIZE):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def commit(self, destination, objects=None, digest=None):
+        """Pubblica il file completo nello storage (nell'archivio oggetti se attivo) e rimuove lo stato"""
+        if objects is not None:
+            objects.store(self.data_path, digest, destination)
+        else:
+            os.replace(self.data_path, destination)
+        self.state_path.unlink(missing_ok=True)
+
+    def abort(self):
+        self.data_path.unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+
+
+# --- Server concorrente con pool di thread limitato ---
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer che serve ogni connessione in un pool di al massimo max_connections thread.
+
+    Raggiunto il limite, il thread di accept attende che una connessione si
+    chiuda: i nuovi client restano nella coda di listen del kernel.
+    """
+
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, max_connections=MAX_CONNECTIONS):
+        super().__init__(server_address, handler_class)
+        self.pool = ThreadPoolExecutor(max_workers=max_connections, thread_name_prefix="file-server")
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
 # --- Avvio del server ---
-def run_server(port=8080, directory="storage", user="admin", password="admin"):
+def run_server(port=8080, directory="storage", user="admin", password="admin",
+               max_connections=MAX_CONNECTIONS, dedup=False):
     FileServerHandler.storage_dir = directory
     FileServerHandler.USERNAME = user
     FileServerHandler.PASSWORD = password
     Path(directory).mkdir(parents=True, exist_ok=True)
-    server = HTTPServer(("", port), FileServerHandler)
+    FileServerHandler.index = DirectoryIndex(directory)
+    if dedup:
+        FileServerHandler.objects = ObjectStore(Path(directory) / OBJECTS_DIR)
+    server = PooledHTTPServer(("", port), FileServerHandler, max_connections)
     print(f"✅ Server avviato su http://localhost:{port}")
+    print(f"🔀 Connessioni concorrenti: max {max_connections} (HTTP/1.1 keep-alive, timeout {KEEPALIVE_TIMEOUT}s)")
     print(f"📂 Directory di upload: {Path(directory).absolute()}")
     print(f"🔑 Username: {user}, Password: {password}")
+    if dedup:
+        print(f"🧬 Deduplicazione attiva: contenuti in {Path(directory, OBJECTS_DIR).absolute()}")
     print("\n💡 Esempio di utilizzo completo:")
     print(f"python3 {sys.argv[0]} 8080 storage admin admin")
     print("Parametri:")
     print("1️⃣ Porta (default 8080)")
     print("2️⃣ Directory di storage (default 'storage')")
     print("3️⃣ Username login (default 'admin')")
-    print("4️⃣ Password login (default 'admin')\n")
+    print("4️⃣ Password login (default 'admin')")
+    print(f"--max-connections N: connessioni servite in parallelo (default {MAX_CONNECTIONS})")
+    print("--dedup: salva ogni contenuto una sola volta (nomi come hardlink)\n")
 
     print("🌐 Browser URL: http://<IP-VM>:8080")
     print("Funzionalità:")
-    print("• Carica file tramite form")
-    print("• Scarica file con /download?file=nomefile")
+    print("• Carica file tramite form (anche più file insieme)")
+    print("• Upload a blocchi riprendibile con /uploads (POST crea, PUT blocchi, POST finalize)")
+    print("• Scarica file con /download?file=nomefile (supporta Range per riprendere i download)")
+    print(f"• Download condizionali (ETag/If-None-Match → 304) e compressi: {', '.join(ENCODINGS)}")
     print("• Cancella file con /delete?file=nomefile")
-    print("• Lista file con /list\n")
+    print(f"• Archivio al volo con /archive?file=a&file=b o ?glob=*.log (formati: {', '.join(ARCHIVE_FORMATS)})")
+    print("• Verifica per hash con /objects/<sha256> (con --dedup: POST ?file=nome evita l'upload)")
+    print("• Cancellazione e stat di più file con POST /batch/delete e /batch/stat (JSON)")
+    print("• Lista file con /list (?prefix=, ?sort=name|size|mtime, ?order=desc, ?offset=, ?limit=, ?format=json)\n")
 
     print("📌 Esempi di chiamate curl:")
 
     print("# Upload file")
     print(f'curl -u {user}:{password} -F "file=@/percorso/del/file.txt" http://<IP-VM>:{port}/upload')
 
+    print("# Upload a blocchi: crea la sessione, invia i blocchi, verifica e pubblica")
+    print(f'curl -u {user}:{password} -X POST "http://<IP-VM>:{port}/uploads?file=big.iso&size=$(stat -c%s big.iso)&chunk_size=8388608"')
+    print(f'dd if=big.iso of=chunk bs=8M skip=0 count=1 && curl -u {user}:{password} -T chunk http://<IP-VM>:{port}/uploads/<id>/0')
+    print(f'curl -u {user}:{password} -X POST "http://<IP-VM>:{port}/uploads/<id>/finalize?sha256=$(sha256sum big.iso | cut -c1-64)"')
+
     print("# Download file")
     print(f'curl -u {user}:{password} -O http://<IP-VM>:{port}/download?file=file.txt')
 
+    print("# Riprendi un download interrotto")
+    print(f'curl -u {user}:{password} -C - -o file.txt http://<IP-VM>:{port}/download?file=file.txt')
+
     print("# Cancella file")
     print(f'curl -u {user}:{password} -X GET http://<IP-VM>:{port}/delete?file=file.txt')
 
+    print("# Scarica tutti i log in un tar.gz")
+    print(f'curl -u {user}:{password} -o logs.tar.gz "http://<IP-VM>:{port}/archive?glob=*.log&format=tar.gz"')
+
+    print("# Cancella più file")
+    print(f"""curl -u {user}:{password} -d '{{"files": ["a.txt", "b.txt"]}}' http://<IP-VM>:{port}/batch/delete""")
+
     print("# Lista file")
     print(f'curl -u {user}:{password} http://<IP-VM>:{port}/list\n')
 
@@ -232,21 +1602,26 @@ def run_server(port=8080, directory="storage", user="admin", password="admin"):
 
 # --- Main ---
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File server HTTP con upload, download e autenticazione")
+    parser.add_argument("port", nargs="?", default="8080", help="porta (default 8080)")
+    parser.add_argument("directory", nargs="?", default="storage", help="directory di storage (default 'storage')")
+    parser.add_argument("user", nargs="?", default="admin", help="username login (default 'admin')")
+    parser.add_argument("password", nargs="?", default=None, help="password login (default 'admin')")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help=f"connessioni servite in parallelo (default {MAX_CONNECTIONS})")
+    parser.add_argument("--dedup", action="store_true",
+                        help="archivio content-addressed: contenuti identici salvati una sola volta")
+    args = parser.parse_args()
+
     port = 8080
-    directory = "storage"
-    user = "admin"
-    password = "admin"
+    try:
+        port = int(args.port)
+    except ValueError:
+        print("⚠️ Porta non valida, uso default 8080")
+    # Come in passato, username e password si cambiano solo se indicati entrambi
+    user, password = "admin", "admin"
+    if args.password is not None:
+        user, password = args.user, args.password
 
-    if len(sys.argv) >= 2:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print("⚠️ Porta non valida, uso default 8080")
-    if len(sys.argv) >= 3:
-        directory = sys.argv[2]
-    if len(sys.argv) >= 5:
-        user = sys.argv[3]
-        password = sys.argv[4]
-
-    run_server(port, directory, user, password)
+    run_server(port, args.directory, user, password, max(1, args.max_connections), args.dedup)
 
@@ -4,34 +4,177 @@ Memory Share - Collaborative text sharing application
 Users can join rooms and share/edit text in real-time with formatting preserved
 """
 
+import os
+
+# Production workers serve many idle websockets with eventlet, which has to
+# patch the standard library before anything else is imported
+if os.environ.get('MEMORY_SHARE_WORKER') is not None:
+    try:
+        import eventlet
+        eventlet.monkey_patch()
+    except ImportError:
+        eventlet = None
+
 from flask import Flask, render_template, request, send_file, jsonify
-from flask_socketio import SocketIO, join_room, emit
+from flask_socketio import SocketIO
 from werkzeug.utils import secure_filename
-import os
+import argparse
+import atexit
+import bisect
+import hashlib
+import io
+import json
+import re
+import signal
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import deque
 from pathlib import Path
+from stat import S_ISREG
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import bus
+import ot
+
+# Production mode (python app.py PORT --workers N) runs one process per worker.
+# Each room belongs to the worker its name hashes to: the other workers forward
+# the room's events to it over the message bus, which also carries Socket.IO
+# broadcasts between workers
+WORKER_ID = int(os.environ.get('MEMORY_SHARE_WORKER', '0'))
+WORKERS = int(os.environ.get('MEMORY_SHARE_WORKERS', '1'))
+BUS_URL = os.environ.get('MEMORY_SHARE_BUS')
+BROADCAST_CHANNEL = 'memory-share:workers'
+BUS_REQUEST_TIMEOUT = 10
+worker_bus = bus.connect(BUS_URL) if BUS_URL else None
+pending_requests = {}
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'memory-share-secret-key-2023'
 app.config['MAX_CONTENT_LENGTH'] = 20 * 1024 * 1024 * 1024  # 20GB max file size
-socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=20 * 1024 * 1024 * 1024)
+socketio = SocketIO(app, cors_allowed_origins="*", max_http_buffer_size=20 * 1024 * 1024 * 1024,
+                    **({'client_manager': bus.BusManager(worker_bus)} if worker_bus else {}))
 
 # Directory to store room data
 ROOMS_DIR = Path('rooms')
 ROOMS_DIR.mkdir(exist_ok=True)
 
+# Optional content-addressed storage shared by all rooms (MEMORY_SHARE_DEDUP=1):
+# each uploaded content is stored once and room files are hardlinks to it
+DEDUP_STORAGE = os.environ.get('MEMORY_SHARE_DEDUP', '0') == '1'
+OBJECTS_DIR = ROOMS_DIR / '.objects'
+UPLOAD_BLOCK_SIZE = 1024 * 1024
+SHA256_RE = re.compile(r'[0-9a-f]{64}')
+if DEDUP_STORAGE:
+    OBJECTS_DIR.mkdir(exist_ok=True)
+
+
+class ObjectsLock:
+    """Serializes changes to the object store between threads and worker processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        if fcntl is not None:
+            self.file = open(self.path, 'a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        self.thread_lock.release()
+
+
+objects_lock = ObjectsLock(OBJECTS_DIR / '.lock')
+
+# Operations kept per room to transform edits based on an older version and
+# to catch up reconnecting clients; clients further behind get the whole content
+HISTORY_LIMIT = 500
+# Per-room operation log, compacted into chat.txt once it grows past either limit
+OPLOG_FILE = '.oplog'
+OPLOG_TMP = '.oplog.tmp'
+COMPACT_OPS = 1000
+COMPACT_SIZE = 4 * 1024 * 1024
+# Room state (documents, outboxes, Socket.IO rooms) is keyed by the room
+# directory name, so that names sanitizing to the same directory share it
+documents = {}
+documents_lock = threading.Lock()
+# Rooms joined by the clients connected to this worker
+client_rooms = {}
+client_rooms_lock = threading.Lock()
+
+# Room contents live in memory and are written back in the background: after
+# FLUSH_DELAY seconds without edits, once FLUSH_SIZE characters changed, or at
+# most FLUSH_MAX_DELAY seconds after the first unsaved edit
+FLUSH_DELAY = float(os.environ.get('MEMORY_SHARE_FLUSH_DELAY', '2'))
+FLUSH_SIZE = int(os.environ.get('MEMORY_SHARE_FLUSH_SIZE', str(1024 * 1024)))
+FLUSH_MAX_DELAY = 30
+FLUSH_TICK = 0.5
+# Rooms above LARGE_CONTENT_SIZE characters are sent as a read-only window of
+# lines that clients page through, instead of the whole content. Off by default
+# (0), so existing rooms stay editable unless the threshold is set
+LARGE_CONTENT_SIZE = int(os.environ.get('MEMORY_SHARE_LARGE_CONTENT', '0'))
+WINDOW_LINES = 500
+MAX_WINDOW_LINES = 5000
+LINE_INDEX_BLOCK = 64 * 1024
+# Memory budget for cached room contents: rooms without clients are evicted
+# (least recently used first) when the total goes above it
+CACHE_BUDGET = int(os.environ.get('MEMORY_SHARE_CACHE_MB', '256')) * 1024 * 1024
+flusher_started = False
+
+# File lists of the rooms, by room directory; /files returns them in pages
+manifests = {}
+manifests_lock = threading.Lock()
+FILES_PAGE_SIZE = 200
+MAX_FILES_PAGE_SIZE = 1000
+
+# Changes to a room are queued and broadcast as at most one 'updates' frame per
+# BROADCAST_TICK seconds; frames above BROADCAST_COMPRESS_SIZE bytes are sent
+# as zlib-compressed JSON
+BROADCAST_TICK = float(os.environ.get('MEMORY_SHARE_BROADCAST_TICK', '0.04'))
+BROADCAST_COMPRESS_SIZE = 16 * 1024
+outboxes = {}
+outboxes_pending = set()
+outboxes_lock = threading.Lock()
+broadcaster_started = False
+
+
+def safe_room_name(room_name):
+    """Sanitize room name for filesystem"""
+    safe_name = "".join(c for c in room_name if c.isalnum() or c in ('-', '_')).rstrip()
+    return safe_name or "default"
+
 
 def get_room_dir(room_name):
     """Get the directory path for a room"""
-    # Sanitize room name for filesystem
-    safe_name = "".join(c for c in room_name if c.isalnum() or c in ('-', '_')).rstrip()
-    if not safe_name:
-        safe_name = "default"
-    room_dir = ROOMS_DIR / safe_name
+    room_dir = ROOMS_DIR / safe_room_name(room_name)
     room_dir.mkdir(exist_ok=True)
     return room_dir
 
 
+def room_owner(room_name):
+    """Index of the worker holding the state of a room"""
+    return zlib.crc32(safe_room_name(room_name).encode('utf-8')) % WORKERS
+
+
+def worker_channel(worker):
+    return f'memory-share:worker:{worker}'
+
+
 def get_room_file(room_name):
     """Get the chat file path for a room"""
     return get_room_dir(room_name) / "chat.txt"
@@ -47,25 +190,618 @@ def load_room_content(room_name):
 
 
 def save_room_content(room_name, content):
-    """Save content to room chat file"""
+    """Save content to room chat file, replacing it atomically"""
     room_file = get_room_file(room_name)
-    with open(room_file, 'w', encoding='utf-8') as f:
-        f.write(content)
+    fd, tmp_path = tempfile.mkstemp(dir=room_file.parent, prefix='.chat-', suffix='.tmp')
+    os.fchmod(fd, 0o644)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, room_file)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+class LineIndex:
+    """Line/offset index of a text: the newlines before each block of LINE_INDEX_BLOCK characters"""
+
+    def __init__(self, text, version):
+        self.version = version
+        self.counts = [0]
+        for start in range(0, len(text), LINE_INDEX_BLOCK):
+            self.counts.append(self.counts[-1] + text.count('\n', start, start + LINE_INDEX_BLOCK))
+        self.lines = self.counts[-1] + 1
+
+    def offset(self, text, line):
+        """Offset of the first character of a line"""
+        if line <= 0:
+            return 0
+        if line >= self.lines:
+            return len(text)
+        # The block holding the newline that ends the previous line
+        block = bisect.bisect_left(self.counts, line) - 1
+        position = block * LINE_INDEX_BLOCK
+        for _ in range(line - self.counts[block]):
+            position = text.index('\n', position) + 1
+        return position
+
+    def slice(self, text, start, count):
+        """Lines start to start+count of text, without the last newline"""
+        end = self.offset(text, start + count)
+        if start + count < self.lines:
+            end -= 1
+        return text[self.offset(text, start):end]
+
+
+class RoomDocument:
+    """Shared text of a room with its version and the latest operations applied.
+
+    On disk a room is a snapshot (chat.txt) plus an append-only log of the
+    operations applied after it (.oplog). The first log line records the
+    version and sha256 of the snapshot it continues, the following lines one
+    operation each; the log is compacted into a new snapshot periodically.
+    """
+
+    def __init__(self, room_name, content):
+        self.room_name = room_name
+        self.content = content
+        self.version = 0
+        self.history = deque(maxlen=HISTORY_LIMIT)
+        self.lock = threading.Lock()
+        # Write-behind state, protected by lock
+        self.saved_version = 0
+        self.unsaved = 0
+        self.pending_log = []
+        self.first_change = self.last_change = 0.0
+        self.deleted = False
+        # Log file state, protected by flush_lock; log_size None means no usable log
+        self.flush_lock = threading.Lock()
+        self.log_size = None
+        self.log_ops = 0
+        # Cache state, protected by documents_lock
+        self.clients = set()
+        self.last_access = time.monotonic()
+        # LineIndex of the content for large rooms, built when a window is requested
+        self.line_index = None
+
+    @classmethod
+    def load(cls, room_name):
+        """Load a room from its snapshot, replaying the operation log written after it"""
+        content = load_room_content(room_name)
+        digest = content_digest(content)
+        document = cls(room_name, content)
+        room_dir = get_room_dir(room_name)
+        # A compaction interrupted after replacing chat.txt leaves the new log in OPLOG_TMP
+        for name in (OPLOG_FILE, OPLOG_TMP):
+            path = room_dir / name
+            try:
+                with open(path, 'rb') as log:
+                    header = json.loads(log.readline())
+                    if header.get('sha256') != digest:
+                        continue
+                    if name == OPLOG_TMP:
+                        os.replace(path, room_dir / OPLOG_FILE)
+                    document.replay(log, header['base'])
+                break
+            except FileNotFoundError:
+                continue
+            except (ValueError, KeyError, TypeError):
+                continue
+        return document
+
+    def replay(self, log, base):
+        """Apply the operations of an open log, truncating a partially written tail"""
+        self.version = self.saved_version = base
+        size = log.tell()
+        for line in log:
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError('truncated line')
+                entry = json.loads(line)
+                if entry['v'] != self.version + 1 or not ot.is_valid(entry['op']):
+                    raise ValueError('unexpected entry')
+                self.content = ot.apply(entry['op'], self.content)
+            except (ValueError, KeyError, TypeError):
+                break
+            self.history.append((entry['op'], entry.get('c'), entry.get('s')))
+            self.version = self.saved_version = entry['v']
+            self.log_ops += 1
+            size += len(line)
+        if size < os.fstat(log.fileno()).st_size:
+            os.truncate(get_room_dir(self.room_name) / OPLOG_FILE, size)
+        self.log_size = size
+
+    @property
+    def dirty(self):
+        return self.version != self.saved_version
+
+    def size(self):
+        """Approximate memory used by the content"""
+        return sys.getsizeof(self.content)
+
+    def needs_flush(self, now):
+        with self.lock:
+            return self.dirty and (self.unsaved >= FLUSH_SIZE
+                                   or now - self.last_change >= FLUSH_DELAY
+                                   or now - self.first_change >= FLUSH_MAX_DELAY)
+
+    def flush(self):
+        """Append the operations applied since the last flush to the log, compacting it when large"""
+        with self.flush_lock:
+            with self.lock:
+                if self.deleted or not self.dirty:
+                    return
+                content, version = self.content, self.version
+                lines, self.pending_log = self.pending_log, []
+                self.unsaved = 0
+                self.first_change = time.monotonic()
+            try:
+                if (self.log_size is None or self.log_size >= COMPACT_SIZE
+                        or self.log_ops + len(lines) >= COMPACT_OPS):
+                    self.compact(content, version)
+                else:
+                    data = ''.join(lines).encode('utf-8')
+                    with open(get_room_dir(self.room_name) / OPLOG_FILE, 'ab') as log:
+                        log.write(data)
+                        log.flush()
+                        os.fsync(log.fileno())
+                    self.log_size += len(data)
+                    self.log_ops += len(lines)
+            except BaseException:
+                # The unsaved operations are gone from pending_log: the next flush
+                # writes a complete snapshot instead
+                self.log_size = None
+                raise
+            with self.lock:
+                self.saved_version = version
+
+    def compact(self, content, version):
+        """Write content as the new snapshot and start an empty log after it"""
+        room_dir = get_room_dir(self.room_name)
+        header = json.dumps({'base': version, 'sha256': content_digest(content)}) + '\n'
+        with open(room_dir / OPLOG_TMP, 'w', encoding='utf-8') as log:
+            log.write(header)
+            log.flush()
+            os.fsync(log.fileno())
+        save_room_content(self.room_name, content)
+        os.replace(room_dir / OPLOG_TMP, room_dir / OPLOG_FILE)
+        self.log_size = len(header)
+        self.log_ops = 0
+
+    def apply(self, version, ops, client=None, seq=None):
+        """Apply ops made on the given version, transforming them against newer operations.
+
+        Returns the new version and the operation actually applied, or None if
+        the version is no longer in the history or the operation does not fit.
+        """
+        oldest = self.version - len(self.history)
+        if not oldest <= version <= self.version:
+            return None
+        try:
+            for concurrent, _, _ in list(self.history)[version - oldest:]:
+                ops, _ = ot.transform(ops, concurrent)
+            self.content = ot.apply(ops, self.content)
+        except ValueError:
+            return None
+        self.history.append((ops, client, seq))
+        now = time.monotonic()
+        if not self.dirty:
+            self.first_change = now
+        self.last_change = now
+        self.unsaved += sum(len(c) if isinstance(c, str) else -c for c in ops
+                            if isinstance(c, str) or c < 0)
+        self.version += 1
+        self.pending_log.append(json.dumps({'v': self.version, 'op': ops, 'c': client, 's': seq}) + '\n')
+        return self.version, ops
+
+    @property
+    def is_large(self):
+        return 0 < LARGE_CONTENT_SIZE < len(self.content)
+
+    def window(self, start, count):
+        """count lines of the content from line start, or the last ones when start is None"""
+        if self.line_index is None or self.line_index.version != self.version:
+            self.line_index = LineIndex(self.content, self.version)
+        index = self.line_index
+        if start is None:
+            start = index.lines - count
+        start = max(0, min(start, index.lines - 1))
+        return {
+            'version': self.version,
+            'start': start,
+            'lines': index.lines,
+            'length': len(self.content),
+            'text': index.slice(self.content, start, count),
+        }
+
+    def since(self, version):
+        """Operations applied after version as [op, client] pairs, or None if no longer in the history"""
+        oldest = self.version - len(self.history)
+        if isinstance(version, bool) or not isinstance(version, int) or not oldest <= version <= self.version:
+            return None
+        return [[ops, client] for ops, client, _ in list(self.history)[version - oldest:]]
+
+    def is_duplicate(self, version, client, seq):
+        """Whether the client's operation seq was already applied after version.
+
+        A client resends its unacknowledged operation after reconnecting, and
+        the copy sent on the old connection may still arrive.
+        """
+        oldest = self.version - len(self.history)
+        if client is None or seq is None or version < oldest:
+            return False
+        return any(c == client and s == seq for _, c, s in list(self.history)[version - oldest:])
+
+
+def get_document(room_name, sid=None):
+    """Get the in-memory document of a room, loading it from disk on first use.
+
+    When sid is given the client is recorded as a member of the room, which
+    keeps the document in memory until it disconnects.
+    """
+    global flusher_started
+    room_key = safe_room_name(room_name)
+    with documents_lock:
+        if not flusher_started:
+            flusher_started = True
+            socketio.start_background_task(flush_rooms)
+        document = documents.get(room_key)
+        if document is None:
+            document = documents[room_key] = RoomDocument.load(room_key)
+        document.last_access = time.monotonic()
+        if sid is not None:
+            document.clients.add(sid)
+        return document
+
+
+def flush_all_rooms():
+    """Write every room with unsaved changes to disk"""
+    with documents_lock:
+        pending = list(documents.values())
+    for document in pending:
+        try:
+            document.flush()
+        except OSError as e:
+            print(f"Error saving room {document.room_name}: {e}")
+
+
+def evict_idle_rooms():
+    """Drop rooms without clients from memory while the cache is over budget"""
+    with documents_lock:
+        total = sum(document.size() for document in documents.values())
+        if total <= CACHE_BUDGET:
+            return
+        idle = sorted((d for d in documents.values() if not d.clients), key=lambda d: d.last_access)
+    for document in idle:
+        if total <= CACHE_BUDGET:
+            break
+        document.flush()
+        with documents_lock, document.lock:
+            if document.clients or document.dirty or documents.get(document.room_name) is not document:
+                continue
+            del documents[document.room_name]
+        with manifests_lock:
+            manifests.pop(get_room_dir(document.room_name).name, None)
+        with outboxes_lock:
+            outboxes.pop(document.room_name, None)
+        total -= document.size()
+
+
+def flush_rooms():
+    """Background task writing changed rooms to disk and enforcing the memory budget"""
+    while True:
+        socketio.sleep(FLUSH_TICK)
+        now = time.monotonic()
+        with documents_lock:
+            pending = list(documents.values())
+        for document in pending:
+            if document.needs_flush(now):
+                try:
+                    document.flush()
+                except OSError as e:
+                    print(f"Error saving room {document.room_name}: {e}")
+        evict_idle_rooms()
+
+
+def content_digest(content):
+    """sha256 of a room content, as recorded in the operation log header"""
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def file_info(file_path, stat):
+    """Entry of a room file in the file list"""
+    return {
+        'name': file_path.name,
+        'size': stat.st_size,
+        'modified': stat.st_mtime
+    }
+
+
+def is_shared_file(name):
+    """Whether a file of the room directory is listed (chat.txt and the .oplog files are not)"""
+    return name != 'chat.txt' and not name.startswith('.')
+
+
+class RoomManifest:
+    """Files of a room kept in memory, so listing them does not scan the directory.
+
+    Built from disk on first use, then updated by the routes that add or
+    remove files.
+    """
+
+    def __init__(self, room_dir):
+        self.files = {}
+        self.listing = None
+        self.lock = threading.Lock()
+        for file_path in room_dir.iterdir():
+            if is_shared_file(file_path.name):
+                try:
+                    stat = file_path.stat()
+                except FileNotFoundError:
+                    continue
+                if S_ISREG(stat.st_mode):
+                    self.files[file_path.name] = file_info(file_path, stat)
+
+    def add(self, file_path):
+        """Record a new or replaced file and return its entry (None for files that are not listed)"""
+        if not is_shared_file(file_path.name):
+            return None
+        info = file_info(file_path, file_path.stat())
+        with self.lock:
+            self.files[file_path.name] = info
+            self.listing = None
+        return info
+
+    def remove(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+            self.listing = None
+
+    def update(self, added, removed):
+        """Apply changes made by another worker"""
+        with self.lock:
+            for name in removed:
+                self.files.pop(name, None)
+            for info in added:
+                self.files[info['name']] = info
+            self.listing = None
+
+    def sorted_files(self):
+        """All files, most recently modified first"""
+        with self.lock:
+            if self.listing is None:
+                self.listing = sorted(self.files.values(), key=lambda x: x['modified'], reverse=True)
+            return self.listing
+
+
+def get_manifest(room_name):
+    """Get the file manifest of a room, scanning its directory on first use"""
+    room_dir = get_room_dir(room_name)
+    with manifests_lock:
+        manifest = manifests.get(room_dir.name)
+    if manifest is None:
+        # Scanned outside the lock: a large room must not block the others
+        manifest = RoomManifest(room_dir)
+        with manifests_lock:
+            manifest = manifests.setdefault(room_dir.name, manifest)
+    return manifest
 
 
 def get_room_files(room_name):
     """Get list of files in a room (excluding chat.txt)"""
-    room_dir = get_room_dir(room_name)
-    files = []
-    for file_path in room_dir.iterdir():
-        if file_path.is_file() and file_path.name != 'chat.txt':
-            stat = file_path.stat()
-            files.append({
-                'name': file_path.name,
-                'size': stat.st_size,
-                'modified': stat.st_mtime
-            })
-    return sorted(files, key=lambda x: x['modified'], reverse=True)
+    return get_manifest(room_name).sorted_files()
+
+
+class RoomOutbox:
+    """Changes waiting to be broadcast to a room in its next frame"""
+
+    def __init__(self, room_name):
+        self.room_name = room_name
+        self.lock = threading.Lock()
+        self.base = None  # version the first queued operation applies to
+        self.ops = []  # [op, client, version after it] entries
+        self.added = {}
+        self.removed = set()
+
+    def add_operation(self, version, ops, client=None):
+        with self.lock:
+            if not self.ops:
+                self.base = version - 1
+            elif client is None and self.ops[-1][1] is None:
+                # Successive full-content updates: only their combined change is sent
+                ops = ot.compose(self.ops.pop()[0], ops)
+            self.ops.append([ops, client, version])
+        self.schedule()
+
+    def add_files(self, added, removed):
+        with self.lock:
+            # A file added and removed within the same frame only needs the removal
+            for name in removed:
+                self.added.pop(name, None)
+                self.removed.add(name)
+            for info in added:
+                self.removed.discard(info['name'])
+                self.added[info['name']] = info
+        self.schedule()
+
+    def schedule(self):
+        with outboxes_lock:
+            outboxes_pending.add(self)
+
+    def flush(self):
+        """Send the queued changes as one frame"""
+        with self.lock:
+            frame = {}
+            if self.ops:
+                frame['base'] = self.base
+                frame['ops'] = self.ops
+            if self.added or self.removed:
+                frame['files'] = {'added': list(self.added.values()), 'removed': list(self.removed)}
+            if not frame:
+                return
+            self.ops = []
+            self.added = {}
+            self.removed = set()
+
+            payload = json.dumps(frame, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            if len(payload) >= BROADCAST_COMPRESS_SIZE:
+                frame = zlib.compress(payload)
+            # Emitted under the lock so frames reach the clients in order
+            socketio.emit('updates', frame, room=self.room_name)
+
+
+def get_outbox(room_name):
+    """Get the broadcast queue of a room"""
+    global broadcaster_started
+    room_key = safe_room_name(room_name)
+    with outboxes_lock:
+        if not broadcaster_started:
+            broadcaster_started = True
+            socketio.start_background_task(broadcast_rooms)
+        outbox = outboxes.get(room_key)
+        if outbox is None:
+            outbox = outboxes[room_key] = RoomOutbox(room_key)
+        return outbox
+
+
+def broadcast_rooms():
+    """Background task sending the changes queued for each room, one frame per tick"""
+    while True:
+        socketio.sleep(BROADCAST_TICK)
+        with outboxes_lock:
+            pending = list(outboxes_pending)
+            outboxes_pending.clear()
+        for outbox in pending:
+            try:
+                outbox.flush()
+            except Exception as e:
+                print(f"Error broadcasting to room {outbox.room_name}: {e}")
+
+
+def notify_files_changed(room_name, added=(), removed=()):
+    """Send the files added to or removed from a room to its users and the other workers"""
+    changes = {'added': list(added), 'removed': list(removed)}
+    get_outbox(room_name).add_files(changes['added'], changes['removed'])
+    if worker_bus is not None:
+        worker_bus.publish(BROADCAST_CHANNEL, dict(changes, event='files', room=room_name, origin=WORKER_ID))
+
+
+def forget_room(room_name):
+    """Drop the cached state of a room about to be deleted, so that no pending flush recreates it"""
+    with documents_lock:
+        document = documents.pop(safe_room_name(room_name), None)
+    if document is not None:
+        with document.flush_lock, document.lock:
+            document.deleted = True
+
+
+def room_content(room_name):
+    """Current content of a room"""
+    document = get_document(room_name)
+    with document.lock:
+        return document.content
+
+
+def request_owner(room_name, name):
+    """Run a request on the worker owning the room and return its result"""
+    owner = room_owner(room_name)
+    if owner == WORKER_ID:
+        return OWNER_REQUESTS[name](room_name)
+    request_id = uuid.uuid4().hex
+    reply = pending_requests[request_id] = {'done': threading.Event()}
+    try:
+        worker_bus.publish(worker_channel(owner), {'event': 'request', 'name': name, 'room': room_name,
+                                                   'id': request_id, 'reply_to': WORKER_ID})
+        if not reply['done'].wait(BUS_REQUEST_TIMEOUT):
+            raise TimeoutError(f'worker {owner} did not answer')
+    finally:
+        pending_requests.pop(request_id, None)
+    return reply['result']
+
+
+# Requests other workers send to the owner of a room
+OWNER_REQUESTS = {'content': room_content, 'forget': forget_room}
+
+
+def object_path(digest):
+    """Get the path of the stored object with this sha256"""
+    return OBJECTS_DIR / digest[:2] / digest
+
+
+def publish_object_link(tmp_path, file_path):
+    """Move a link to an object into place, collecting the object it replaces"""
+    overwritten = file_path.exists()
+    os.replace(tmp_path, file_path)
+    if overwritten:
+        socketio.start_background_task(collect_orphan_objects)
+
+
+def store_object(tmp_path, digest, file_path):
+    """Publish tmp_path as file_path, sharing the existing object if the content is known"""
+    obj = object_path(digest)
+    obj.parent.mkdir(exist_ok=True)
+    with objects_lock:
+        try:
+            os.link(tmp_path, obj)
+        except FileExistsError:
+            # Same content already stored: turn the temp file into a link to it,
+            # touched so the new name is listed as just modified
+            os.unlink(tmp_path)
+            os.link(obj, tmp_path)
+            os.utime(obj)
+        except OSError:
+            # No hardlink support: keep the file without deduplication
+            pass
+    publish_object_link(tmp_path, file_path)
+
+
+def link_object(digest, file_path):
+    """Create file_path as a link to an existing object; False if it is unknown"""
+    tmp_path = OBJECTS_DIR / f'{os.urandom(16).hex()}.link'
+    with objects_lock:
+        try:
+            os.link(object_path(digest), tmp_path)
+        except FileNotFoundError:
+            return False
+        os.utime(tmp_path)
+    publish_object_link(tmp_path, file_path)
+    return True
+
+
+def save_upload(file, file_path):
+    """Save an uploaded file, hashing it while streaming when deduplication is enabled"""
+    if not DEDUP_STORAGE:
+        file.save(str(file_path))
+        return
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=OBJECTS_DIR, suffix='.part')
+    os.fchmod(fd, 0o644)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while block := file.stream.read(UPLOAD_BLOCK_SIZE):
+                digest.update(block)
+                out.write(block)
+        store_object(tmp_path, digest.hexdigest(), file_path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+def collect_orphan_objects():
+    """Remove stored objects that no room file links to anymore"""
+    with objects_lock:
+        for prefix in OBJECTS_DIR.iterdir():
+            if not prefix.is_dir():
+                continue
+            for obj in prefix.iterdir():
+                try:
+                    if obj.stat().st_nlink == 1:
+                        obj.unlink()
+                except FileNotFoundError:
+                    continue
 
 
 @app.route('/')
@@ -92,26 +828,78 @@ def upload_file(room_name):
     
     if file:
         filename = secure_filename(file.filename)
+        if not filename or not is_shared_file(filename):
+            return jsonify({'error': 'Invalid file name'}), 400
         room_dir = get_room_dir(room_name)
         file_path = room_dir / filename
         
         # Save file
-        file.save(str(file_path))
+        save_upload(file, file_path)
         
         # Notify other users
-        files_list = get_room_files(room_name)
-        socketio.emit('files_updated', {'files': files_list}, room=room_name)
+        info = get_manifest(room_name).add(file_path)
+        notify_files_changed(room_name, added=[info])
         
         return jsonify({'success': True, 'filename': filename})
     
     return jsonify({'error': 'Upload failed'}), 500
 
 
+@app.route('/room/<room_name>/objects/<digest>')
+def check_object(room_name, digest):
+    """Check whether a content is already stored, so the client can skip the upload"""
+    if not DEDUP_STORAGE:
+        return jsonify({'error': 'Deduplication disabled'}), 404
+    digest = digest.lower()
+    if not SHA256_RE.fullmatch(digest):
+        return jsonify({'error': 'Invalid sha256'}), 400
+    obj = object_path(digest)
+    if not obj.exists():
+        return jsonify({'sha256': digest, 'exists': False}), 404
+    return jsonify({'sha256': digest, 'exists': True, 'size': obj.stat().st_size})
+
+
+@app.route('/room/<room_name>/objects/<digest>', methods=['POST'])
+def add_object(room_name, digest):
+    """Add an already stored content to a room under a new name, without uploading it"""
+    if not DEDUP_STORAGE:
+        return jsonify({'error': 'Deduplication disabled'}), 404
+    digest = digest.lower()
+    if not SHA256_RE.fullmatch(digest):
+        return jsonify({'error': 'Invalid sha256'}), 400
+    filename = secure_filename((request.get_json(silent=True) or {}).get('filename', ''))
+    if not filename or not is_shared_file(filename):
+        return jsonify({'error': 'No file name provided'}), 400
+
+    file_path = get_room_dir(room_name) / filename
+    if not link_object(digest, file_path):
+        return jsonify({'sha256': digest, 'exists': False}), 404
+
+    # Notify other users
+    info = get_manifest(room_name).add(file_path)
+    notify_files_changed(room_name, added=[info])
+
+    return jsonify({'success': True, 'filename': filename}), 201
+
+
 @app.route('/room/<room_name>/files')
 def list_files(room_name):
-    """Get list of files in a room"""
+    """Get a page of the files in a room (?offset=&limit=)"""
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', FILES_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    if offset < 0 or not 0 < limit <= MAX_FILES_PAGE_SIZE:
+        return jsonify({'error': f'offset must be >= 0 and limit between 1 and {MAX_FILES_PAGE_SIZE}'}), 400
+
     files = get_room_files(room_name)
-    return jsonify({'files': files})
+    return jsonify({
+        'files': files[offset:offset + limit],
+        'total': len(files),
+        'offset': offset,
+        'limit': limit
+    })
 
 
 @app.route('/room/<room_name>/download/<filename>')
@@ -121,7 +909,8 @@ def download_file(room_name, filename):
     file_path = room_dir / secure_filename(filename)
     
     if file_path.exists() and file_path.is_file():
-        return send_file(str(file_path), as_attachment=True)
+        # Absolute: Flask resolves relative paths against the app directory, not the cwd
+        return send_file(str(file_path.resolve()), as_attachment=True)
     
     return jsonify({'error': 'File not found'}), 404
 
@@ -130,9 +919,13 @@ def download_file(room_name, filename):
 def download_chat(room_name):
     """Download the chat content as a text file"""
     room_file = get_room_file(room_name)
+
+    # chat.txt is only rewritten on log compaction: send the current content
+    content = request_owner(room_name, 'content')
     
-    if room_file.exists():
-        return send_file(str(room_file), as_attachment=True, download_name=f"{room_name}_chat.txt")
+    if content or room_file.exists():
+        return send_file(io.BytesIO(content.encode('utf-8')), mimetype='text/plain',
+                         as_attachment=True, download_name=f"{room_name}_chat.txt")
     
     return jsonify({'error': 'Chat not found'}), 404
 
@@ -145,10 +938,12 @@ def delete_file(room_name, filename):
     
     if file_path.exists() and file_path.is_file() and file_path.name != 'chat.txt':
         file_path.unlink()
+        get_manifest(room_name).remove(file_path.name)
+        if DEDUP_STORAGE:
+            socketio.start_background_task(collect_orphan_objects)
         
         # Notify other users
-        files_list = get_room_files(room_name)
-        socketio.emit('files_updated', {'files': files_list}, room=room_name)
+        notify_files_changed(room_name, removed=[file_path.name])
         
         return jsonify({'success': True})
     
@@ -162,65 +957,309 @@ def delete_room(room_name):
     room_dir = get_room_dir(room_name)
     
     if room_dir.exists():
+        # Forget the cached content so that no pending flush recreates the room
+        request_owner(room_name, 'forget')
+        with manifests_lock:
+            manifests.pop(room_dir.name, None)
+        if worker_bus is not None:
+            worker_bus.publish(BROADCAST_CHANNEL, {'event': 'room_deleted', 'room': room_name,
+                                                   'origin': WORKER_ID})
+
         # Remove entire directory and all contents
         shutil.rmtree(room_dir)
+        if DEDUP_STORAGE:
+            socketio.start_background_task(collect_orphan_objects)
         
         # Notify all users in the room
-        socketio.emit('room_deleted', {'message': 'Stanza eliminata'}, room=room_name)
+        socketio.emit('room_deleted', {'message': 'Stanza eliminata'}, room=room_dir.name)
         
         return jsonify({'success': True})
     
     return jsonify({'error': 'Room not found'}), 404
 
 
-@socketio.on('join')
-def on_join(data):
+def room_join(sid, data):
     """Handle user joining a room"""
     room_name = data['room']
-    join_room(room_name)
-    
-    # Load and send existing content
-    content = load_room_content(room_name)
-    emit('load_content', {'content': content})
-    
-    # Send list of files
+
+    # A reconnecting client sends the last version it saw and only gets the
+    # operations it missed; others get the content with its version, the base
+    # of the client's operations
+    document = get_document(room_name, sid)
+    with document.lock:
+        # Joined under the lock: operations broadcast later arrive after the content,
+        # and the queued ones are sent first so that no frame straddles its version
+        get_outbox(room_name).flush()
+        socketio.server.enter_room(sid, document.room_name, namespace='/')
+        missed = document.since(data.get('version'))
+        if missed is not None:
+            socketio.emit('catch_up', {'version': document.version, 'ops': missed}, to=sid)
+        elif document.is_large:
+            # Too big for the editor: the client pages through a window of lines
+            start = data.get('start')
+            if isinstance(start, bool) or not isinstance(start, int):
+                start = None
+            socketio.emit('load_window', document.window(start, WINDOW_LINES), to=sid)
+        else:
+            socketio.emit('load_content', {'content': document.content, 'version': document.version}, to=sid)
+
+    # Send the whole list of files; later updates only carry the changes
     files = get_room_files(room_name)
-    emit('files_updated', {'files': files})
-    
+    socketio.emit('files_updated', {'files': files}, to=sid)
+
     # Notify others
-    emit('user_joined', {'room': room_name}, room=room_name, skip_sid=request.sid)
+    socketio.emit('user_joined', {'room': room_name}, room=document.room_name, skip_sid=sid)
+
+
+def room_operation(sid, data):
+    """Handle an edit sent as an operation on a known version of the content"""
+    room_name = data['room']
+    ops = data.get('op')
+    version = data.get('version')
+    client = data.get('client')
+    seq = data.get('seq')
+    if not ot.is_valid(ops) or not isinstance(version, int):
+        return
+    if not isinstance(client, str) or len(client) > 64:
+        client = None
+    if not isinstance(seq, int):
+        seq = None
+
+    document = get_document(room_name)
+    with document.lock:
+        if document.is_duplicate(version, client, seq):
+            return
+        result = document.apply(version, ops, client, seq)
+        if result is None:
+            # Too far behind or out of sync: start again from the current content
+            get_outbox(room_name).flush()
+            socketio.emit('resync', {'content': document.content, 'version': document.version}, to=sid)
+            return
+        version, ops = result
+        if document.unsaved >= FLUSH_SIZE:
+            socketio.start_background_task(document.flush)
+
+        # Queued under the lock so every client receives operations in version order;
+        # the sender recognizes its client id in the frame as the ack
+        get_outbox(room_name).add_operation(version, ops, client)
+
+
+def room_content_update(sid, data):
+    """Handle a full content replacement, sent to the room as an operation"""
+    room_name = data['room']
+    content = data['content']
+
+    document = get_document(room_name)
+    with document.lock:
+        ops = ot.diff(document.content, content)
+        if ot.is_noop(ops) or not ot.is_valid(ops):
+            return
+        version, ops = document.apply(document.version, ops)
+        if document.unsaved >= FLUSH_SIZE:
+            socketio.start_background_task(document.flush)
+
+        get_outbox(room_name).add_operation(version, ops)
+
+
+def room_fetch_lines(sid, data):
+    """Send a window of lines of a large room"""
+    room_name = data['room']
+    start = data.get('start')
+    count = data.get('count', WINDOW_LINES)
+    if isinstance(start, bool) or not isinstance(start, (int, type(None))):
+        return
+    if isinstance(count, bool) or not isinstance(count, int):
+        return
+    count = max(1, min(count, MAX_WINDOW_LINES))
+
+    document = get_document(room_name)
+    with document.lock:
+        if document.is_large:
+            socketio.emit('window', document.window(start, count), to=sid)
+        else:
+            # Small enough again: switch the client back to the editor
+            get_outbox(room_name).flush()
+            socketio.emit('load_content', {'content': document.content, 'version': document.version}, to=sid)
+
+
+def room_leave(sid, data):
+    """Handle a client of the room disconnecting"""
+    with documents_lock:
+        document = documents.get(safe_room_name(data['room']))
+        if document is not None:
+            document.clients.discard(sid)
+
+
+ROOM_EVENTS = {
+    'join': room_join,
+    'operation': room_operation,
+    'content_update': room_content_update,
+    'fetch_lines': room_fetch_lines,
+    'leave': room_leave,
+}
+
+
+def dispatch_room_event(event, sid, data):
+    """Run a room event here or on the worker owning the room"""
+    owner = room_owner(data['room'])
+    if owner == WORKER_ID:
+        ROOM_EVENTS[event](sid, data)
+    else:
+        worker_bus.publish(worker_channel(owner), {'event': event, 'sid': sid, 'data': data})
+
+
+def handle_worker_message(message):
+    """Run a room event or request forwarded to this worker, or take a reply"""
+    event = message['event']
+    if event in ROOM_EVENTS:
+        ROOM_EVENTS[event](message['sid'], message['data'])
+    elif event == 'request':
+        result = OWNER_REQUESTS[message['name']](message['room'])
+        worker_bus.publish(worker_channel(message['reply_to']),
+                           {'event': 'reply', 'id': message['id'], 'result': result})
+    elif event == 'reply':
+        reply = pending_requests.get(message['id'])
+        if reply is not None:
+            reply['result'] = message['result']
+            reply['done'].set()
+
+
+def handle_broadcast(message):
+    """Apply a change another worker made to the rooms' files"""
+    if message['origin'] == WORKER_ID:
+        return
+    room_key = safe_room_name(message['room'])
+    with manifests_lock:
+        manifest = manifests.get(room_key)
+        if message['event'] == 'room_deleted':
+            manifests.pop(room_key, None)
+    if manifest is not None and message['event'] == 'files':
+        manifest.update(message['added'], message['removed'])
+
+
+def listen_bus(channel, handler):
+    """Background task handling the messages of a bus channel in order"""
+    for message in worker_bus.listen(channel):
+        try:
+            handler(message)
+        except Exception as e:
+            print(f"Error handling {message.get('event')} from the bus: {e}")
+
+
+@socketio.on('join')
+def on_join(data):
+    """Handle user joining a room"""
+    with client_rooms_lock:
+        client_rooms.setdefault(request.sid, set()).add(data['room'])
+    dispatch_room_event('join', request.sid, data)
+
+
+@socketio.on('operation')
+def on_operation(data):
+    """Handle an edit sent as an operation on a known version of the content"""
+    dispatch_room_event('operation', request.sid, data)
 
 
 @socketio.on('content_update')
 def on_content_update(data):
     """Handle content updates from users"""
-    room_name = data['room']
-    content = data['content']
-    
-    # Save to file
-    save_room_content(room_name, content)
-    
-    # Broadcast to all users in the room except sender
-    emit('content_changed', {'content': content}, room=room_name, skip_sid=request.sid)
+    dispatch_room_event('content_update', request.sid, data)
+
+
+@socketio.on('fetch_lines')
+def on_fetch_lines(data):
+    """Handle a request for some lines of a large room"""
+    dispatch_room_event('fetch_lines', request.sid, data)
 
 
 @socketio.on('disconnect')
 def on_disconnect():
     """Handle user disconnection"""
-    pass
+    with client_rooms_lock:
+        rooms = client_rooms.pop(request.sid, ())
+    for room_name in rooms:
+        dispatch_room_event('leave', request.sid, {'room': room_name})
+
+
+# Unsaved room contents are written out when the server stops
+atexit.register(flush_all_rooms)
+
+
+def run_workers(port, workers, bus_url):
+    """Start the production workers on port, port+1, ... and restart them if they exit"""
+    if bus_url is None and workers > 1:
+        # No external bus: workers talk through a hub on a local Unix socket
+        hub_path = os.path.join(tempfile.gettempdir(), f'memory-share-{port}.sock')
+        hub = bus.LocalHub(hub_path)
+        threading.Thread(target=hub.serve_forever, daemon=True).start()
+        bus_url = f'unix://{hub_path}'
+
+    processes = {}
+
+    def start(index):
+        env = dict(os.environ, MEMORY_SHARE_WORKER=str(index), MEMORY_SHARE_WORKERS=str(workers))
+        if bus_url is not None:
+            env['MEMORY_SHARE_BUS'] = bus_url
+        processes[index] = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(port + index)],
+                                            env=env)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    for index in range(workers):
+        start(index)
+    print(f"Started {workers} Memory Share workers on ports {port}-{port + workers - 1}"
+          f"{f' (bus {bus_url})' if bus_url else ''}")
+    print("Put them behind a proxy with sticky sessions, for example in nginx:")
+    print("    upstream memory_share {")
+    print("        ip_hash;")
+    for index in range(workers):
+        print(f"        server 127.0.0.1:{port + index};")
+    print("    }")
+
+    while not stopping.wait(1):
+        for index, process in list(processes.items()):
+            if process.poll() is not None:
+                print(f"Worker {index} exited with code {process.returncode}, restarting")
+                start(index)
+
+    # Workers flush their rooms on SIGTERM
+    for process in processes.values():
+        process.terminate()
+    for process in processes.values():
+        process.wait()
+
+
+def run_worker(port):
+    """Run one production worker"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if worker_bus is not None:
+        socketio.start_background_task(listen_bus, worker_channel(WORKER_ID), handle_worker_message)
+        socketio.start_background_task(listen_bus, BROADCAST_CHANNEL, handle_broadcast)
+    if socketio.async_mode == 'threading':
+        print(f"Worker {WORKER_ID}: eventlet is not installed, using threads")
+    socketio.run(app, host='0.0.0.0', port=port, allow_unsafe_werkzeug=True)
 
 
 if __name__ == '__main__':
-    # Get port from command line argument or use default
-    port = 5000
-    if len(sys.argv) > 1:
-        try:
-            port = int(sys.argv[1])
-        except ValueError:
-            print(f"Invalid port number: {sys.argv[1]}")
-            print("Usage: python app.py [port]")
-            sys.exit(1)
-    
-    print(f"Starting Memory Share server on port {port}")
-    print(f"Access at: http://localhost:{port}")
-    socketio.run(app, host='0.0.0.0', port=port, debug=True)
+    parser = argparse.ArgumentParser(description='Memory Share server')
+    parser.add_argument('port', nargs='?', type=int, default=5000,
+                        help='port to listen on; workers use port, port+1, ... (default 5000)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='production mode: number of worker processes behind a sticky proxy')
+    parser.add_argument('--bus', default=None,
+                        help='message bus between workers, e.g. redis://localhost:6379/0 '
+                             '(default: a local Unix socket)')
+    args = parser.parse_args()
+
+    if os.environ.get('MEMORY_SHARE_WORKER') is not None:
+        run_worker(args.port)
+    elif args.workers > 0:
+        run_workers(args.port, args.workers, args.bus)
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        print(f"Starting Memory Share server on port {args.port}")
+        print(f"Access at: http://localhost:{args.port}")
+        socketio.run(app, host='0.0.0.0', port=args.port, debug=True)
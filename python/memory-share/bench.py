@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+Memory Share Bench - Test di carico di app.py in locale
+Uso: python bench.py [--workers N]... [--rooms N] [--clients M] [--protocol operation|content_update]
+Esempio: python bench.py --rooms 20 --clients 5 --edit-rate 4 --workers 1 --workers 4
+
+Per ogni configurazione avvia app.py (python app.py PORTA --workers N) in una
+cartella temporanea, collega N stanze x M client Socket.IO e misura:
+  edit      - latenza di propagazione di una modifica agli altri utenti della
+              stanza (p50/p99), modifiche e messaggi ricevuti al secondo
+  transfer  - upload, download ed elenco file concorrenti (p50/p99, MB/s)
+  server    - RSS massima dei processi del server e byte scritti su disco
+Con --protocol content_update ogni client invia il contenuto completo e vince
+l'ultimo: le modifiche sovrascritte risultano in meno consegne e latenze più alte.
+Prima del test verifica che due nomi della stessa stanza (bench-alias, bench-alias!)
+condividano il contenuto.
+I risultati vengono scritti in JSON per confrontare le versioni tra commit.
+Le variabili MEMORY_SHARE_* dell'ambiente vengono passate al server.
+Richiede python-socketio con il client (requests, websocket-client).
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import requests
+import socketio
+
+import ot
+
+APP_SCRIPT = Path(__file__).with_name("app.py")
+
+# Ogni modifica inserisce una riga "[id]": chi la riceve risale all'istante di invio
+TOKEN_RE = re.compile(r"\[(\d+)\]")
+
+
+# --- Utilità ---
+def free_ports(count):
+    """count porte consecutive libere su loopback"""
+    for _ in range(50):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            first = s.getsockname()[1]
+        if first + count > 65535:
+            continue
+        try:
+            for port in range(first, first + count):
+                with socket.socket() as s:
+                    s.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        return list(range(first, first + count))
+    raise RuntimeError(f"nessun intervallo di {count} porte libere")
+
+
+def wait_for_port(port, timeout=20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"la porta {port} non risponde dopo {timeout}s")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def summarize(samples):
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "samples": len(samples),
+        "p50_ms": to_ms(percentile(samples, 50)),
+        "p99_ms": to_ms(percentile(samples, 99)),
+        "mean_ms": to_ms(statistics.fmean(samples)) if samples else None,
+        "max_ms": to_ms(max(samples)) if samples else None,
+    }
+
+
+# --- Processi del server (Linux, tramite /proc) ---
+def process_tree(pid):
+    """pid e tutti i suoi discendenti"""
+    children = {}
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # Il nome del processo può contenere spazi: i campi seguono l'ultima parentesi
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(entry.name))
+    tree = [pid]
+    for current in tree:
+        tree.extend(children.get(current, ()))
+    return tree
+
+
+def read_proc_field(pids, filename, field):
+    """Somma di un campo numerico di /proc/PID/<filename> sui processi, None se non disponibile"""
+    total = None
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/{filename}").read_text().splitlines():
+                if line.startswith(field + ":"):
+                    total = (total or 0) + int(line.split()[1])
+                    break
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+class ServerMonitor:
+    """Campiona RSS e byte scritti dai processi del server durante il test"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.rss_peak_kb = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        pids = process_tree(self.pid)
+        rss = read_proc_field(pids, "status", "VmRSS")
+        if rss is not None:
+            self.rss_peak_kb = max(self.rss_peak_kb or 0, rss)
+        return pids, rss
+
+    def write_bytes(self):
+        return read_proc_field(process_tree(self.pid), "io", "write_bytes")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+
+# --- Client simulati ---
+class Stats:
+    """Contatori condivisi da tutti i client"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.sent = {}  # id della modifica -> (istante di invio, client)
+        self.latencies = []
+        self.edits = 0
+        self.skipped = 0
+        self.frames = 0
+        self.compressed = 0
+        self.gaps = 0
+        self.errors = []
+
+    def error(self, message):
+        with self.lock:
+            self.errors.append(message)
+
+
+class SimClient:
+    """Utente di una stanza con il protocollo di room.html (operazioni) o content_update"""
+
+    def __init__(self, stats, name, room, port, protocol):
+        self.stats = stats
+        self.name = name
+        self.room = room
+        self.url = f"http://127.0.0.1:{port}"
+        self.protocol = protocol
+        self.lock = threading.Lock()
+        self.text = ""  # contenuto con la modifica in attesa di conferma
+        self.server_text = ""
+        self.version = 0
+        self.outstanding = None
+        self.seq = 0
+        self.large = False
+        # Ultimo id ricevuto da ogni client: con content_update un contenuto vecchio
+        # può reinserire righe cancellate, che non sono nuove consegne
+        self.last_seen = {}
+        self.loaded = threading.Event()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on("load_content", self.on_load)
+        self.sio.on("resync", self.on_load)
+        self.sio.on("load_window", self.on_window)
+        self.sio.on("updates", self.on_updates)
+
+    def connect(self):
+        self.sio.connect(self.url)
+        self.sio.emit("join", {"room": self.room})
+        if not self.loaded.wait(15):
+            raise RuntimeError(f"{self.name}: contenuto della stanza non ricevuto")
+
+    def disconnect(self):
+        try:
+            self.sio.disconnect()
+        except Exception:
+            pass
+
+    def on_load(self, data):
+        with self.lock:
+            self.text = self.server_text = data["content"]
+            self.version = data["version"]
+            self.outstanding = None
+        self.loaded.set()
+
+    def on_window(self, data):
+        # Stanza oltre la soglia dei documenti grandi: si può solo leggere
+        with self.lock:
+            self.large = True
+            self.version = data["version"]
+        self.loaded.set()
+
+    def on_updates(self, data):
+        received = time.perf_counter()
+        if isinstance(data, bytes):
+            data = json.loads(zlib.decompress(data))
+            with self.stats.lock:
+                self.stats.compressed += 1
+        with self.stats.lock:
+            self.stats.frames += 1
+        if "ops" not in data or self.large:
+            return
+
+        tokens = []
+        with self.lock:
+            base = data["base"]
+            for op, client, version in data["ops"]:
+                if version > self.version:
+                    if base != self.version:
+                        # Operazione persa: si riparte dal contenuto completo
+                        with self.stats.lock:
+                            self.stats.gaps += 1
+                        self.sio.emit("join", {"room": self.room})
+                        break
+                    if client == self.name and self.outstanding is not None:
+                        self.server_text = ot.apply(self.outstanding, self.server_text)
+                        self.outstanding = None
+                    else:
+                        self.server_text = ot.apply(op, self.server_text)
+                        local = op
+                        if self.outstanding is not None:
+                            self.outstanding, local = ot.transform(self.outstanding, op)
+                        self.text = ot.apply(local, self.text)
+                        tokens.extend(TOKEN_RE.findall("".join(c for c in op if isinstance(c, str))))
+                    self.version = version
+                base = version
+
+        with self.stats.lock:
+            for token in sorted(map(int, tokens)):
+                sent = self.stats.sent.get(token)
+                if sent is not None and sent[1] != self.name and token > self.last_seen.get(sent[1], 0):
+                    self.last_seen[sent[1]] = token
+                    self.stats.latencies.append(received - sent[0])
+
+    def edit(self):
+        """Inserisce una riga con un nuovo id all'inizio di una riga a caso"""
+        with self.lock:
+            if self.large or (self.protocol == "operation" and self.outstanding is not None):
+                with self.stats.lock:
+                    self.stats.skipped += 1
+                return
+            # content_update invia il contenuto completo, basato sull'ultima versione ricevuta
+            text = self.text if self.protocol == "operation" else self.server_text
+            edit_id = next(self.stats.ids)
+            position = text.rfind("\n", 0, random.randint(0, len(text))) + 1
+            line = f"[{edit_id}]\n"
+            with self.stats.lock:
+                self.stats.sent[edit_id] = (time.perf_counter(), self.name)
+                self.stats.edits += 1
+            if self.protocol == "operation":
+                op = [c for c in (position, line, len(text) - position) if c]
+                self.text = text[:position] + line + text[position:]
+                self.outstanding = op
+                self.seq += 1
+                message = {"room": self.room, "version": self.version, "client": self.name,
+                           "seq": self.seq, "op": op}
+                self.sio.emit("operation", message)
+            else:
+                self.sio.emit("content_update", {"room": self.room,
+                                                 "content": text[:position] + line + text[position:]})
+
+    def run_edits(self, rate, deadline):
+        while True:
+            delay = random.expovariate(rate)
+            if time.monotonic() + delay >= deadline:
+                return
+            time.sleep(delay)
+            try:
+                self.edit()
+            except Exception as e:
+                self.stats.error(f"{self.name}: {e}")
+
+
+# --- Test ---
+def check_room_aliases(port):
+    """Nomi di stanza che finiscono nella stessa cartella devono condividere il contenuto.
+
+    Restituisce None se la modifica arriva all'altro nome, altrimenti il motivo.
+    """
+    stats = Stats()
+    writer = SimClient(stats, "alias-writer", "bench-alias", port, "operation")
+    reader = SimClient(stats, "alias-reader", "bench-alias!", port, "operation")
+    try:
+        writer.connect()
+        reader.connect()
+        writer.edit()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            with reader.lock:
+                if "[1]" in reader.text:
+                    return None
+            time.sleep(0.05)
+        return "la modifica non è arrivata al client di bench-alias!"
+    except (RuntimeError, socketio.exceptions.ConnectionError) as e:
+        return str(e)
+    finally:
+        writer.disconnect()
+        reader.disconnect()
+
+
+def bench_transfers(ports, rooms, clients, file_kb, deadline):
+    """Upload, download ed elenco file in loop, ogni client su stanze e worker a rotazione"""
+    payload = os.urandom(file_kb * 1024)
+    samples = {"upload": [], "download": [], "list": []}
+    errors = []
+    transferred = [0]
+    lock = threading.Lock()
+
+    def client(index):
+        session = requests.Session()
+        for n in itertools.count():
+            if time.monotonic() >= deadline:
+                return
+            url = f"http://127.0.0.1:{ports[(index + n) % len(ports)]}/room/{rooms[(index + n) % len(rooms)]}"
+            name = f"bench-{index}-{n}.bin"
+            try:
+                started = time.perf_counter()
+                session.post(f"{url}/upload", files={"file": (name, payload)}).raise_for_status()
+                uploaded = time.perf_counter()
+                response = session.get(f"{url}/download/{name}")
+                response.raise_for_status()
+                if len(response.content) != len(payload):
+                    raise RuntimeError(f"scaricati {len(response.content)} byte invece di {len(payload)}")
+                downloaded = time.perf_counter()
+                session.get(f"{url}/files", params={"limit": 50}).raise_for_status()
+                listed = time.perf_counter()
+            except (requests.RequestException, RuntimeError) as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                samples["upload"].append(uploaded - started)
+                samples["download"].append(downloaded - uploaded)
+                samples["list"].append(listed - downloaded)
+                transferred[0] += 2 * len(payload)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    result = {name: summarize(values) for name, values in samples.items()}
+    result.update({
+        "clients": clients,
+        "file_kb": file_kb,
+        "mb_per_sec": round(transferred[0] / elapsed / 1e6, 1) if elapsed else None,
+        "errors": len(errors),
+    })
+    return result
+
+
+def run_configuration(workers, args):
+    """Avvia app.py con il numero di worker indicato ed esegue il test di carico"""
+    label = f"{workers} worker"
+    print(f"[*] {label}: {args.rooms} stanze x {args.clients} client, {args.protocol}")
+    ports = free_ports(workers)
+    workdir = Path(tempfile.mkdtemp(prefix="memory-share-bench-"))
+    log = open(workdir / "server.log", "wb")
+    command = [sys.executable, str(APP_SCRIPT), str(ports[0]), "--workers", str(workers)]
+    server = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    stats = Stats()
+    clients = []
+    try:
+        try:
+            for port in ports:
+                wait_for_port(port)
+        except RuntimeError:
+            server.kill()
+            server.wait()
+            log.close()
+            output = (workdir / "server.log").read_text(errors="replace").strip().splitlines()
+            raise RuntimeError(f"il server non è partito: {' | '.join(output[-3:])}")
+
+        alias_error = check_room_aliases(ports[0])
+        if alias_error is not None:
+            print(f"[!] {label}: stanze con nomi equivalenti separate: {alias_error}")
+
+        monitor = ServerMonitor(server.pid)
+        _, idle_rss = monitor.sample()
+        rooms = [f"bench-{n}" for n in range(args.rooms)]
+        for n in range(args.rooms * args.clients):
+            room = rooms[n // args.clients]
+            clients.append(SimClient(stats, f"client-{n}", room, ports[n % workers], args.protocol))
+        connect_started = time.monotonic()
+        for client in clients:
+            client.connect()
+        connect_seconds = time.monotonic() - connect_started
+
+        monitor.thread.start()
+        written_before = monitor.write_bytes()
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=client.run_edits, args=(args.edit_rate, deadline))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        transfers = None
+        if args.transfer_clients:
+            transfers = bench_transfers(ports, rooms, args.transfer_clients, args.file_kb, deadline)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        # Attende le ultime consegne e il salvataggio in background delle stanze
+        time.sleep(args.settle)
+        monitor.stopped.set()
+        _, end_rss = monitor.sample()
+        written_after = monitor.write_bytes()
+
+        converged = 0
+        for room in rooms:
+            members = [c for c in clients if c.room == room]
+            states = []
+            for client in members:
+                with client.lock:
+                    states.append((client.text, client.version, client.outstanding))
+            if len({state[:2] for state in states}) == 1 and not any(state[2] for state in states):
+                converged += 1
+
+        with stats.lock:
+            peers = args.clients - 1
+            edit = summarize(stats.latencies)
+            edit.update({
+                "edits": stats.edits,
+                "edits_per_sec": round(stats.edits / elapsed, 1),
+                "skipped_edits": stats.skipped,
+                "deliveries": len(stats.latencies),
+                "expected_deliveries": stats.edits * peers,
+                "frames_received": stats.frames,
+                "frames_per_sec": round(stats.frames / elapsed, 1),
+                "compressed_frames": stats.compressed,
+                "gaps": stats.gaps,
+                "rooms_converged": converged,
+                "errors": len(stats.errors),
+            })
+        to_mb = lambda kb: round(kb / 1024, 1) if kb is not None else None
+        result = {
+            "label": label,
+            "workers": workers,
+            "connect_seconds": round(connect_seconds, 3),
+            "alias_check": alias_error or "ok",
+            "edit": edit,
+            "server": {
+                "rss_idle_mb": to_mb(idle_rss),
+                "rss_peak_mb": to_mb(monitor.rss_peak_kb),
+                "rss_end_mb": to_mb(end_rss),
+                "disk_write_mb": (round((written_after - written_before) / 1e6, 2)
+                                  if written_before is not None and written_after is not None else None),
+            },
+        }
+        if transfers is not None:
+            result["transfer"] = transfers
+        print(f"    edit:     p50 {edit['p50_ms']} ms, p99 {edit['p99_ms']} ms, "
+              f"{edit['edits_per_sec']} modifiche/s, {edit['frames_per_sec']} messaggi/s, "
+              f"{converged}/{len(rooms)} stanze allineate")
+        if transfers is not None:
+            print(f"    transfer: upload p50 {transfers['upload']['p50_ms']} ms, "
+                  f"download p50 {transfers['download']['p50_ms']} ms, {transfers['mb_per_sec']} MB/s")
+        print(f"    server:   RSS max {result['server']['rss_peak_mb']} MB, "
+              f"scritti {result['server']['disk_write_mb']} MB")
+        return result
+    finally:
+        for client in clients:
+            client.disconnect()
+        if server.poll() is None:
+            # Il launcher ferma i worker, che salvano le stanze prima di uscire
+            server.terminate()
+            try:
+                server.wait(15)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+        log.close()
+        if args.keep:
+            print(f"    cartella del server: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=APP_SCRIPT.parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Test di carico di memory-share su loopback (nessuna rete esterna)",
+        epilog="Esempio: python bench.py --rooms 20 --clients 5 --workers 1 --workers 4",
+    )
+    parser.add_argument("--workers", type=int, action="append", default=[],
+                        help="worker del server (app.py --workers N); ripetibile, una esecuzione per valore "
+                             "(default 1)")
+    parser.add_argument("--rooms", type=int, default=10, help="stanze simulate (default 10)")
+    parser.add_argument("--clients", type=int, default=5, help="client Socket.IO per stanza (default 5)")
+    parser.add_argument("--protocol", choices=("operation", "content_update"), default="operation",
+                        help="come i client inviano le modifiche: operazioni come room.html o "
+                             "contenuto completo (default operation)")
+    parser.add_argument("--edit-rate", type=float, default=2,
+                        help="modifiche al secondo per client (default 2)")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="durata in secondi del test (default 10)")
+    parser.add_argument("--transfer-clients", type=int, default=2,
+                        help="client concorrenti di upload/download, 0 per disattivarli (default 2)")
+    parser.add_argument("--file-kb", type=int, default=256,
+                        help="KiB di ogni file caricato e scaricato (default 256)")
+    parser.add_argument("--settle", type=float, default=3,
+                        help="secondi di attesa a fine test per consegne e salvataggi (default 3)")
+    parser.add_argument("--keep", action="store_true",
+                        help="non cancellare la cartella temporanea del server (stanze e log)")
+    parser.add_argument("--output", default="memory-share-bench.json",
+                        help="file JSON dei risultati (default memory-share-bench.json)")
+    args = parser.parse_args()
+    if args.rooms < 1 or args.clients < 1 or args.edit_rate <= 0:
+        parser.error("--rooms, --clients e --edit-rate devono essere positivi")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("workers", "output", "keep")},
+        "environment": {key: value for key, value in os.environ.items() if key.startswith("MEMORY_SHARE_")},
+        "results": [],
+    }
+    try:
+        for workers in args.workers or [1]:
+            try:
+                report["results"].append(run_configuration(workers, args))
+            except (RuntimeError, OSError, socketio.exceptions.ConnectionError) as e:
+                print(f"[!] {workers} worker: {e}")
+                report["results"].append({"label": f"{workers} worker", "workers": workers, "error": str(e)})
+    except KeyboardInterrupt:
+        print("\n[*] Interrotto, salvo i risultati parziali")
+
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"[*] Risultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
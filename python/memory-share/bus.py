@@ -0,0 +1,183 @@
+"""
+Message bus connecting the worker processes of memory-share
+
+Both implementations have the same interface: publish() sends a message to
+every process listening on a channel, listen() yields the messages of a
+channel as they arrive. Messages are pickled, so only trusted processes may
+connect.
+
+LocalBus - hub on a Unix socket run by the launcher, for tests and a single host
+RedisBus - Redis pub/sub, independent of the launcher process
+"""
+
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+
+import socketio
+
+_LENGTH = struct.Struct('!I')
+RECONNECT_DELAY = 1
+
+
+def _send_frame(sock, payload):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('bus connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def _recv_frame(sock):
+    length, = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return _recv_exactly(sock, length)
+
+
+class LocalBus:
+    """Client of a LocalHub listening on a Unix socket"""
+
+    def __init__(self, path):
+        self.path = path
+        self.publisher = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def publish(self, channel, message):
+        frame = pickle.dumps(('pub', channel, message))
+        with self.lock:
+            if self.publisher is None:
+                self.publisher = self._connect()
+            try:
+                _send_frame(self.publisher, frame)
+            except OSError:
+                # The hub restarted: reconnect once
+                self.publisher.close()
+                self.publisher = self._connect()
+                _send_frame(self.publisher, frame)
+
+    def listen(self, channel):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                _send_frame(sock, pickle.dumps(('sub', channel, None)))
+                while True:
+                    yield pickle.loads(_recv_frame(sock))
+            except OSError:
+                # Hub gone: messages published meanwhile are lost, as with Redis
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                sock.close()
+
+
+class LocalHub:
+    """Relays every published frame to the connections subscribed to its channel"""
+
+    def __init__(self, path):
+        self.path = path
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            os.unlink(path)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(path)
+        self.server.listen(64)
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.server.accept()
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        channel = None
+        send_lock = threading.Lock()
+        try:
+            while True:
+                op, frame_channel, message = pickle.loads(_recv_frame(conn))
+                if op == 'sub':
+                    channel = frame_channel
+                    with self.lock:
+                        self.subscribers.setdefault(channel, []).append((conn, send_lock))
+                    continue
+                payload = pickle.dumps(message)
+                with self.lock:
+                    targets = list(self.subscribers.get(frame_channel, ()))
+                for target, target_lock in targets:
+                    try:
+                        with target_lock:
+                            _send_frame(target, payload)
+                    except OSError:
+                        pass
+        except (ConnectionError, OSError, pickle.UnpicklingError, ValueError):
+            pass
+        finally:
+            if channel is not None:
+                with self.lock:
+                    self.subscribers[channel].remove((conn, send_lock))
+            conn.close()
+
+
+class RedisBus:
+    """Bus over Redis pub/sub (requires the redis package)"""
+
+    def __init__(self, url):
+        import redis
+        self.errors = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+        self.redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, pickle.dumps(message))
+
+    def listen(self, channel):
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(channel)
+                for item in pubsub.listen():
+                    if item['type'] == 'message':
+                        yield pickle.loads(item['data'])
+            except self.errors:
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                pubsub.close()
+
+
+def connect(url):
+    """Open the bus described by url: unix:///path/to/socket or redis://host:port/db"""
+    if url.startswith('unix://'):
+        return LocalBus(url[len('unix://'):])
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBus(url)
+    raise ValueError(f'unsupported bus url: {url}')
+
+
+class BusManager(socketio.PubSubManager):
+    """Socket.IO client manager sharing rooms and emits between workers over a bus"""
+
+    name = 'memory-share-bus'
+
+    def __init__(self, bus, channel='memory-share:socketio'):
+        super().__init__(channel=channel)
+        self.bus = bus
+
+    def _publish(self, data):
+        self.bus.publish(self.channel, data)
+
+    def _listen(self):
+        yield from self.bus.listen(self.channel)
@@ -0,0 +1,202 @@
+"""
+Operational transformation for plain text documents
+
+An operation is a list of components applied from the start of the document:
+a positive int retains that many characters, a negative int deletes that many
+characters and a string inserts it. Lengths are counted in code points.
+room.html uses the same format, so operations travel as plain JSON.
+"""
+
+import re
+
+# Halves of a surrogate pair cannot be stored as UTF-8
+_SURROGATE_RE = re.compile('[\ud800-\udfff]')
+
+
+def _retain(ops, n):
+    if n <= 0:
+        return
+    if ops and isinstance(ops[-1], int) and ops[-1] > 0:
+        ops[-1] += n
+    else:
+        ops.append(n)
+
+
+def _insert(ops, text):
+    if not text:
+        return
+    # Canonical form: an insert always comes before an adjacent delete
+    if ops and isinstance(ops[-1], str):
+        ops[-1] += text
+    elif ops and isinstance(ops[-1], int) and ops[-1] < 0:
+        if len(ops) > 1 and isinstance(ops[-2], str):
+            ops[-2] += text
+        else:
+            ops.insert(len(ops) - 1, text)
+    else:
+        ops.append(text)
+
+
+def _delete(ops, n):
+    if n <= 0:
+        return
+    if ops and isinstance(ops[-1], int) and ops[-1] < 0:
+        ops[-1] -= n
+    else:
+        ops.append(-n)
+
+
+def is_valid(ops):
+    """Check that ops is a well-formed operation received from a client"""
+    if not isinstance(ops, list):
+        return False
+    for component in ops:
+        if isinstance(component, bool) or not isinstance(component, (int, str)):
+            return False
+        if component == 0 or component == "":
+            return False
+        if isinstance(component, str) and _SURROGATE_RE.search(component):
+            return False
+    return True
+
+
+def base_length(ops):
+    """Length of the document the operation applies to"""
+    return sum(abs(c) for c in ops if isinstance(c, int))
+
+
+def target_length(ops):
+    """Length of the document after applying the operation"""
+    return sum(c if isinstance(c, int) else len(c) for c in ops if not isinstance(c, int) or c > 0)
+
+
+def is_noop(ops):
+    return all(isinstance(c, int) and c > 0 for c in ops)
+
+
+def apply(ops, text):
+    """Apply an operation to text, raising ValueError if the lengths do not match"""
+    if base_length(ops) != len(text):
+        raise ValueError("operation does not match the document length")
+    parts = []
+    index = 0
+    for component in ops:
+        if isinstance(component, str):
+            parts.append(component)
+        elif component > 0:
+            parts.append(text[index:index + component])
+            index += component
+        else:
+            index -= component
+    return "".join(parts)
+
+
+def transform(a, b):
+    """Transform two concurrent operations on the same document.
+
+    Returns (a', b') such that apply(b', apply(a, doc)) == apply(a', apply(b, doc)).
+    When both insert at the same position, a's text goes first.
+    """
+    if base_length(a) != base_length(b):
+        raise ValueError("concurrent operations must apply to the same document")
+    a_prime, b_prime = [], []
+    ops_a, ops_b = iter(a), iter(b)
+    op_a, op_b = next(ops_a, None), next(ops_b, None)
+    while op_a is not None or op_b is not None:
+        if isinstance(op_a, str):
+            _insert(a_prime, op_a)
+            _retain(b_prime, len(op_a))
+            op_a = next(ops_a, None)
+            continue
+        if isinstance(op_b, str):
+            _retain(a_prime, len(op_b))
+            _insert(b_prime, op_b)
+            op_b = next(ops_b, None)
+            continue
+        if op_a is None or op_b is None:
+            raise ValueError("operations have different lengths")
+
+        if op_a > 0 and op_b > 0:
+            step = min(op_a, op_b)
+            _retain(a_prime, step)
+            _retain(b_prime, step)
+        elif op_a < 0 and op_b < 0:
+            # Both delete the same text: nothing left to do for either
+            step = min(-op_a, -op_b)
+        elif op_a < 0:
+            step = min(-op_a, op_b)
+            _delete(a_prime, step)
+        else:
+            step = min(op_a, -op_b)
+            _delete(b_prime, step)
+
+        op_a = _consume(op_a, step, ops_a)
+        op_b = _consume(op_b, step, ops_b)
+    return a_prime, b_prime
+
+
+def compose(a, b):
+    """Single operation with the effect of a followed by b"""
+    if target_length(a) != base_length(b):
+        raise ValueError("operations do not compose")
+    ops = []
+    ops_a, ops_b = iter(a), iter(b)
+    op_a, op_b = next(ops_a, None), next(ops_b, None)
+    while op_a is not None or op_b is not None:
+        if isinstance(op_a, int) and op_a < 0:
+            _delete(ops, -op_a)
+            op_a = next(ops_a, None)
+            continue
+        if isinstance(op_b, str):
+            _insert(ops, op_b)
+            op_b = next(ops_b, None)
+            continue
+
+        # b retains or deletes what a retained or inserted
+        if isinstance(op_a, str):
+            step = min(len(op_a), abs(op_b))
+            if op_b > 0:
+                _insert(ops, op_a[:step])
+            op_a = op_a[step:] or next(ops_a, None)
+        else:
+            step = min(op_a, abs(op_b))
+            if op_b > 0:
+                _retain(ops, step)
+            else:
+                _delete(ops, step)
+            op_a = _consume(op_a, step, ops_a)
+        op_b = _consume(op_b, step, ops_b)
+    return ops
+
+
+def _consume(component, step, rest):
+    """Shorten a retain/delete component by step, moving to the next one when used up"""
+    remaining = abs(component) - step
+    if remaining == 0:
+        return next(rest, None)
+    return remaining if component > 0 else -remaining
+
+
+def diff(old, new):
+    """Operation turning old into new, built from their common prefix and suffix"""
+    limit = min(len(old), len(new))
+    prefix = _common_length(old, new, limit, lambda s, n: s[:n])
+    suffix = _common_length(old, new, limit - prefix, lambda s, n: s[len(s) - n:])
+    ops = []
+    _retain(ops, prefix)
+    _insert(ops, new[prefix:len(new) - suffix])
+    _delete(ops, len(old) - prefix - suffix)
+    _retain(ops, suffix)
+    return ops
+
+
+def _common_length(a, b, limit, part):
+    # Binary search on slice comparisons: runs in C instead of a per-character loop
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if part(a, middle) == part(b, middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
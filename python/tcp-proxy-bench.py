@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+TCP Proxy Bench - Benchmark riproducibile di tcp-proxy.py, solo su loopback
+Uso: python tcp-proxy-bench.py [--proxy-args "ARGS"]... [--direct] [--output FILE]
+Esempio: python tcp-proxy-bench.py --proxy-args "--mode select" --proxy-args "--mode threaded"
+
+Per ogni configurazione avvia un server di test locale (echo/sink) e il proxy,
+poi misura:
+  connect  - connessioni/s (connect, 1 byte andata e ritorno, close)
+  bulk     - MB/s aggregati di stream che inviano dati verso il sink
+  latency  - p50/p99 del round trip di messaggi piccoli in echo
+I risultati vengono scritti in JSON per confrontare modalità e buffer tra commit.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import shlex
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+PROXY_SCRIPT = Path(__file__).with_name("tcp-proxy.py")
+
+# Primo byte della connessione: sceglie il comportamento del server di test
+MODE_ECHO = b"E"
+MODE_SINK = b"S"
+
+
+# --- Server di test (processo separato, asyncio) ---
+async def handle_test_client(reader, writer):
+    try:
+        mode = await reader.readexactly(1)
+        if mode == MODE_SINK:
+            # Scarta tutto fino a EOF e risponde con il numero di byte ricevuti
+            total = 0
+            while chunk := await reader.read(1024 * 1024):
+                total += len(chunk)
+            writer.write(struct.pack("!Q", total))
+        else:
+            while chunk := await reader.read(64 * 1024):
+                writer.write(chunk)
+                await writer.drain()
+        await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def run_test_server(port, ready):
+    async def main():
+        server = await asyncio.start_server(handle_test_client, "127.0.0.1", port, backlog=4096)
+        ready.set()
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(main())
+
+
+# --- Utilità ---
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"la porta {port} non risponde dopo {timeout}s")
+
+
+def recv_exactly(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connessione chiusa prima del previsto")
+        data += chunk
+    return bytes(data)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def run_threads(count, target, *args):
+    results = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            result = target(*args)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        with lock:
+            results.append(result)
+
+    threads = [threading.Thread(target=worker) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, errors
+
+
+# --- Test ---
+def bench_connect(port, concurrency, duration):
+    """Connessioni/s: ogni thread apre, usa e chiude connessioni finché dura il test"""
+    deadline = time.monotonic() + duration
+
+    def client():
+        count = 0
+        while time.monotonic() < deadline:
+            with socket.create_connection(("127.0.0.1", port)) as sock:
+                sock.sendall(MODE_ECHO + b"x")
+                recv_exactly(sock, 1)
+            count += 1
+        return count
+
+    started = time.monotonic()
+    counts, errors = run_threads(concurrency, client)
+    elapsed = time.monotonic() - started
+    total = sum(counts)
+    return {
+        "concurrency": concurrency,
+        "connections": total,
+        "seconds": round(elapsed, 3),
+        "connections_per_sec": round(total / elapsed, 1),
+        "errors": len(errors),
+    }
+
+
+def bench_bulk(port, streams, megabytes, chunk_size):
+    """MB/s aggregati: ogni stream invia megabytes MiB al sink e attende la conferma"""
+    total_bytes = megabytes * 1024 * 1024
+    chunk = b"\0" * chunk_size
+
+    def client():
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.sendall(MODE_SINK)
+            sent = 0
+            while sent < total_bytes:
+                n = min(chunk_size, total_bytes - sent)
+                sock.sendall(chunk[:n] if n < chunk_size else chunk)
+                sent += n
+            sock.shutdown(socket.SHUT_WR)
+            received, = struct.unpack("!Q", recv_exactly(sock, 8))
+            if received != total_bytes:
+                raise RuntimeError(f"il sink ha ricevuto {received} byte invece di {total_bytes}")
+            return received
+
+    started = time.monotonic()
+    received, errors = run_threads(streams, client)
+    elapsed = time.monotonic() - started
+    total = sum(received)
+    return {
+        "streams": streams,
+        "megabytes_per_stream": megabytes,
+        "seconds": round(elapsed, 3),
+        "mb_per_sec": round(total / elapsed / 1e6, 1),
+        "errors": len(errors),
+    }
+
+
+def bench_latency(port, clients, requests, message_size):
+    """Round trip di messaggi piccoli in echo, una connessione persistente per client"""
+    message = b"p" * message_size
+
+    def client():
+        samples = []
+        with socket.create_connection(("127.0.0.1", port)) as sock:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(MODE_ECHO)
+            for _ in range(requests):
+                started = time.perf_counter()
+                sock.sendall(message)
+                recv_exactly(sock, message_size)
+                samples.append(time.perf_counter() - started)
+        return samples
+
+    results, errors = run_threads(clients, client)
+    samples = [sample for result in results for sample in result]
+    to_ms = lambda value: round(value * 1000, 3) if value is not None else None
+    return {
+        "clients": clients,
+        "requests_per_client": requests,
+        "message_size": message_size,
+        "samples": len(samples),
+        "p50_ms": to_ms(percentile(samples, 50)),
+        "p99_ms": to_ms(percentile(samples, 99)),
+        "mean_ms": to_ms(statistics.fmean(samples)) if samples else None,
+        "errors": len(errors),
+    }
+
+
+# --- Esecuzione ---
+def run_configuration(label, proxy_args, server_port, args):
+    """Avvia il proxy (se richiesto) ed esegue i test selezionati"""
+    proxy = None
+    port = server_port
+    if proxy_args is not None:
+        port = free_port()
+        command = [sys.executable, str(PROXY_SCRIPT), str(port), "127.0.0.1", str(server_port),
+                   *shlex.split(proxy_args)]
+        proxy = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            wait_for_port(port)
+        except RuntimeError:
+            proxy.kill()
+            raise RuntimeError(f"il proxy non è partito: {proxy.stderr.read().decode().strip()}")
+
+    print(f"[*] {label}")
+    result = {"label": label, "proxy_args": proxy_args}
+    try:
+        if "connect" in args.tests:
+            result["connect"] = bench_connect(port, args.concurrency, args.duration)
+            print(f"    connect: {result['connect']['connections_per_sec']} conn/s")
+        if "bulk" in args.tests:
+            result["bulk"] = bench_bulk(port, args.bulk_streams, args.bulk_mb, args.chunk_size)
+            print(f"    bulk:    {result['bulk']['mb_per_sec']} MB/s")
+        if "latency" in args.tests:
+            result["latency"] = bench_latency(port, args.latency_clients, args.latency_requests,
+                                              args.message_size)
+            print(f"    latency: p50 {result['latency']['p50_ms']} ms, p99 {result['latency']['p99_ms']} ms")
+    finally:
+        if proxy is not None:
+            proxy.kill()
+            proxy.wait()
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PROXY_SCRIPT.parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark di tcp-proxy.py su loopback (nessuna rete esterna)",
+        epilog='Esempio: python tcp-proxy-bench.py --proxy-args "--mode select" '
+               '--proxy-args "--mode threaded --buffer-size 4096"',
+    )
+    parser.add_argument("--proxy-args", action="append", default=[],
+                        help="argomenti extra per tcp-proxy.py; ripetibile, una esecuzione per valore "
+                             "(default: una esecuzione con le opzioni predefinite)")
+    parser.add_argument("--direct", action="store_true",
+                        help="misura anche il server di test senza proxy, come riferimento")
+    parser.add_argument("--tests", default="connect,bulk,latency",
+                        help="test da eseguire, separati da virgola (default connect,bulk,latency)")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="client concorrenti nel test connect (default 20)")
+    parser.add_argument("--duration", type=float, default=3,
+                        help="durata in secondi del test connect (default 3)")
+    parser.add_argument("--bulk-streams", type=int, default=4,
+                        help="stream concorrenti nel test bulk (default 4)")
+    parser.add_argument("--bulk-mb", type=int, default=256,
+                        help="MiB inviati da ogni stream nel test bulk (default 256)")
+    parser.add_argument("--chunk-size", type=int, default=256 * 1024,
+                        help="dimensione delle scritture del client nel test bulk (default 262144)")
+    parser.add_argument("--latency-clients", type=int, default=10,
+                        help="client concorrenti nel test latency (default 10)")
+    parser.add_argument("--latency-requests", type=int, default=1000,
+                        help="round trip per client nel test latency (default 1000)")
+    parser.add_argument("--message-size", type=int, default=64,
+                        help="byte per messaggio nel test latency (default 64)")
+    parser.add_argument("--output", default="tcp-proxy-bench.json",
+                        help="file JSON dei risultati (default tcp-proxy-bench.json)")
+    args = parser.parse_args()
+    args.tests = {name.strip() for name in args.tests.split(",") if name.strip()}
+    unknown = args.tests - {"connect", "bulk", "latency"}
+    if unknown:
+        parser.error(f"test sconosciuti: {', '.join(sorted(unknown))}")
+
+    server_port = free_port()
+    ready = multiprocessing.Event()
+    server = multiprocessing.Process(target=run_test_server, args=(server_port, ready), daemon=True)
+    server.start()
+    if not ready.wait(10):
+        print("[!] Il server di test non è partito")
+        sys.exit(1)
+
+    configurations = []
+    if args.direct:
+        configurations.append(("diretto (senza proxy)", None))
+    for proxy_args in args.proxy_args or [""]:
+        configurations.append((f"proxy {proxy_args}".strip(), proxy_args))
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("proxy_args", "output", "direct", "tests")},
+        "tests": sorted(args.tests),
+        "results": [],
+    }
+    try:
+        for label, proxy_args in configurations:
+            try:
+                report["results"].append(run_configuration(label, proxy_args, server_port, args))
+            except RuntimeError as e:
+                print(f"[!] {label}: {e}")
+                report["results"].append({"label": label, "proxy_args": proxy_args, "error": str(e)})
+    except KeyboardInterrupt:
+        print("\n[*] Interrotto, salvo i risultati parziali")
+    finally:
+        server.terminate()
+
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    print(f"[*] Risultati salvati in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
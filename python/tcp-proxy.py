@@ -1,103 +1,1137 @@
 #!/usr/bin/env python3
 """
 TCP Proxy - Inoltra connessioni TCP da una porta locale verso un server remoto
-Uso: python tcp-proxy.py <local_port> <remote_host> <remote_port>
+Uso: python tcp-proxy.py <local_port> <remote_host> <remote_port> [--mode select|threaded] [--workers N]
+     python tcp-proxy.py --config routes.toml
 Esempio: python tcp-proxy.py 8080 192.168.1.100 80
+
+Modalità di inoltro:
+  select   - un solo thread multiplexa tutte le connessioni con selectors (default)
+  threaded - un thread per client più due thread di inoltro (modalità storica)
+
+Con --workers N vengono avviati N processi che condividono la porta con
+SO_REUSEPORT; SIGTERM chiude gli accept e attende la fine delle connessioni.
+
+Con --backend HOST:PORT si aggiungono altri server remoti, scelti con
+--balance roundrobin|leastconn|hash e controllati con --health-interval.
+
+I messaggi per connessione si attivano con --log-level info|debug; i contatori
+sono esposti in JSON su --stats-port (solo 127.0.0.1) e stampati su stderr
+alla ricezione di SIGUSR1.
+
+Con --config un solo processo serve più route dichiarate in un file TOML o JSON;
+SIGHUP ricarica il file senza interrompere le connessioni già aperte:
+
+    [[routes]]
+    listen = 8080
+    backends = ["10.0.0.1:80", "10.0.0.2:80"]
+    balance = "leastconn"      # opzionale, come --balance
+    health_interval = 5        # opzionale, come --health-interval
+    pool = 2                   # opzionale, come --pool
+    rate_limit_client = "1M"   # opzionali, come le omonime opzioni della riga di comando
+    rate_limit_listener = "50M"
+    idle_timeout = 300
+    connect_timeout = 5
+
+    [[routes]]
+    listen = 2222
+    backends = ["10.0.0.5:22"]
+
+Controllo del flusso (modalità select): ogni verso ha un buffer limitato da
+--high-watermark; oltre quella soglia il lato veloce non viene più letto finché
+il buffer non scende sotto --low-watermark. --rate-limit-client e
+--rate-limit-listener applicano un token bucket (byte/s, suffissi K/M/G) per IP
+del client e per porta; --idle-timeout e --connect-timeout chiudono le
+connessioni inattive o i backend che non rispondono.
 """
 
+import argparse
+import bisect
+import collections
+import errno
+import hashlib
+import heapq
+import json
+import logging
+import os
+import selectors
+import signal
 import socket
 import threading
 import sys
 import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11: solo configurazione JSON
+    tomllib = None
+
+BUFFER_SIZE = 64 * 1024
+DRAIN_TIMEOUT = 30
+HEALTH_INTERVAL = 5
+CONNECT_TIMEOUT = 5
+# Soglie del buffer per verso: oltre HIGH si smette di leggere, sotto LOW si riprende
+HIGH_WATERMARK = 256 * 1024
+LOW_WATERMARK = 64 * 1024
+SIZE_SUFFIXES = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+# Punti virtuali per backend nell'anello del consistent hashing
+HASH_REPLICAS = 100
+# Limiti superiori (secondi) dei bucket degli istogrammi
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+DURATION_BUCKETS = (0.1, 1, 10, 60, 300, 1800, 3600)
+
+log = logging.getLogger("tcp-proxy")
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# os.splice esiste solo su Linux (Python 3.10+)
+SPLICE_AVAILABLE = hasattr(os, "splice")
+
+
+def parse_backend(spec):
+    """Converte "HOST:PORT" in (host, porta); solleva ValueError se non valido"""
+    host, _, port = str(spec).rpartition(":")
+    if not host or not port.isdigit() or not (1 <= int(port) <= 65535):
+        raise ValueError(f"Backend non valido: {spec} (formato HOST:PORT)")
+    return host, int(port)
+
+
+def parse_size(value):
+    """Converte "512K", "10M", "1G" o un numero in byte; solleva ValueError se non valido"""
+    text = str(value).strip().upper()
+    multiplier = SIZE_SUFFIXES.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    size = int(float(text) * multiplier)
+    if size <= 0:
+        raise ValueError(f"Dimensione non valida: {value}")
+    return size
+
+
+def load_routes(path):
+    """Legge il file di configurazione e ritorna {porta locale: opzioni della route}"""
+    with open(path, "rb") as f:
+        if path.endswith(".toml"):
+            if tomllib is None:
+                raise ValueError("la configurazione TOML richiede Python 3.11+, usa JSON")
+            config = tomllib.load(f)
+        else:
+            config = json.load(f)
+
+    routes = {}
+    for entry in config.get("routes", []):
+        port = entry.get("listen")
+        if not isinstance(port, int) or not (1 <= port <= 65535):
+            raise ValueError(f"Porta 'listen' non valida: {port!r}")
+        if port in routes:
+            raise ValueError(f"Porta {port} dichiarata più volte")
+        backends = [parse_backend(spec) for spec in entry.get("backends", [])]
+        if not backends:
+            raise ValueError(f"La route sulla porta {port} non ha backend")
+        balance = entry.get("balance", "roundrobin")
+        if balance not in BackendGroup.STRATEGIES:
+            raise ValueError(f"Strategia di bilanciamento non valida: {balance}")
+        health_interval = entry.get("health_interval")
+        if health_interval is None:
+            health_interval = HEALTH_INTERVAL if len(backends) > 1 else 0
+        routes[port] = {
+            "backends": backends,
+            "balance": balance,
+            "health_interval": health_interval,
+            "pool_size": int(entry.get("pool", 0)),
+            "rate_limit_client": parse_size(entry["rate_limit_client"]) if "rate_limit_client" in entry else None,
+            "rate_limit_listener": parse_size(entry["rate_limit_listener"]) if "rate_limit_listener" in entry else None,
+            "idle_timeout": entry.get("idle_timeout"),
+            "connect_timeout": entry.get("connect_timeout", CONNECT_TIMEOUT),
+        }
+    if not routes:
+        raise ValueError("Nessuna route definita in 'routes'")
+    return routes
+
+
+def start_stats_server(target, port):
+    """Espone target.snapshot() in HTTP su 127.0.0.1 in un thread separato"""
+    handler = type("ProxyStatsHandler", (StatsHandler,), {"proxy": target})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print(f"[*] Statistiche su http://127.0.0.1:{port}/ (pid {os.getpid()})")
+
+
+def relay_buffered(src, dst, buffer_size, count, still_active=None):
+    """Copia src -> dst con recv_into su un buffer riutilizzato; count(n) riceve i byte copiati.
+
+    Se src ha un timeout, allo scadere still_active() decide se continuare ad
+    attendere (l'altro verso è ancora attivo) o chiudere la connessione.
+    """
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    while True:
+        try:
+            n = src.recv_into(buffer)
+        except socket.timeout:
+            if still_active is not None and still_active():
+                continue
+            raise
+        if not n:
+            return
+        dst.sendall(view[:n])
+        count(n)
+
+
+def relay_splice(src, dst, buffer_size, count):
+    """Copia src -> dst nel kernel con os.splice attraverso una pipe; count(n) riceve i byte copiati"""
+    pipe_r, pipe_w = os.pipe()
+    try:
+        if fcntl is not None and hasattr(fcntl, "F_SETPIPE_SZ"):
+            try:
+                fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, buffer_size)
+            except OSError:
+                pass
+        src_fd = src.fileno()
+        dst_fd = dst.fileno()
+        flags = os.SPLICE_F_MOVE
+        while True:
+            n = os.splice(src_fd, pipe_w, buffer_size, flags=flags)
+            if not n:
+                return
+            count(n)
+            while n:
+                n -= os.splice(pipe_r, dst_fd, n, flags=flags)
+    finally:
+        os.close(pipe_r)
+        os.close(pipe_w)
+
+
+class TokenBucket:
+    """Token bucket in byte/s; il consumo può andare in debito, che va poi atteso"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self):
+        with self.lock:
+            self.refill()
+            return self.tokens
+
+    def consume(self, n):
+        """Preleva n byte e ritorna i secondi da attendere prima di trasferirne altri"""
+        with self.lock:
+            self.refill()
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class ConnectionStats:
+    """Contatori di una singola connessione, aggiornati solo dal thread che la inoltra"""
+
+    def __init__(self, client):
+        self.client = client
+        self.backend = None
+        self.started = time.monotonic()
+        self.last_activity = self.started
+        self.connect_latency = None
+        self.client_to_server = 0
+        self.server_to_client = 0
+
+    def add_client_to_server(self, n):
+        self.client_to_server += n
+        self.last_activity = time.monotonic()
+
+    def add_server_to_client(self, n):
+        self.server_to_client += n
+        self.last_activity = time.monotonic()
+
+    def snapshot(self, now):
+        return {
+            "client": self.client,
+            "backend": self.backend,
+            "age": round(now - self.started, 3),
+            "connect_latency": self.connect_latency,
+            "bytes_client_to_server": self.client_to_server,
+            "bytes_server_to_client": self.server_to_client,
+        }
+
+
+class Histogram:
+    """Istogramma a bucket fissi: le_X conta i valori compresi tra il bucket precedente e X"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def snapshot(self):
+        result = {f"le_{bound}": count for bound, count in zip(self.buckets, self.counts)}
+        result["inf"] = self.counts[-1]
+        result["count"] = sum(self.counts)
+        result["sum"] = round(self.total, 6)
+        return result
+
+
+class ProxyStats:
+    """Contatori aggregati e per connessione di un proxy, mantenuti in memoria.
+
+    I byte delle connessioni aperte sono tenuti nei rispettivi ConnectionStats
+    e sommati al totale solo alla chiusura, così il relay non prende lock.
+    """
+
+    def __init__(self):
+        # RLock: lo snapshot può essere chiamato dal signal handler di SIGUSR1
+        # mentre il thread principale è già dentro un metodo che tiene il lock
+        self.lock = threading.RLock()
+        self.started = time.monotonic()
+        self.active = set()
+        self.connections_total = 0
+        self.connect_errors = 0
+        self.closed_client_to_server = 0
+        self.closed_server_to_client = 0
+        self.connect_latency = Histogram(LATENCY_BUCKETS)
+        self.duration = Histogram(DURATION_BUCKETS)
+
+    def open(self, addr):
+        conn = ConnectionStats(f"{addr[0]}:{addr[1]}")
+        with self.lock:
+            self.active.add(conn)
+            self.connections_total += 1
+        return conn
+
+    def connected(self, conn, backend, latency):
+        conn.backend = str(backend)
+        conn.connect_latency = round(latency, 6)
+        with self.lock:
+            self.connect_latency.observe(latency)
+
+    def connect_failed(self):
+        with self.lock:
+            self.connect_errors += 1
+
+    def close(self, conn):
+        with self.lock:
+            if conn not in self.active:
+                return
+            self.active.discard(conn)
+            self.closed_client_to_server += conn.client_to_server
+            self.closed_server_to_client += conn.server_to_client
+            self.duration.observe(time.monotonic() - conn.started)
+
+    def snapshot(self, connections=False):
+        now = time.monotonic()
+        with self.lock:
+            active = list(self.active)
+            result = {
+                "uptime": round(now - self.started, 3),
+                "connections_active": len(active),
+                "connections_total": self.connections_total,
+                "connect_errors": self.connect_errors,
+                "bytes_client_to_server": self.closed_client_to_server
+                + sum(c.client_to_server for c in active),
+                "bytes_server_to_client": self.closed_server_to_client
+                + sum(c.server_to_client for c in active),
+                "connect_latency": self.connect_latency.snapshot(),
+                "duration": self.duration.snapshot(),
+            }
+        if connections:
+            result["connections"] = [c.snapshot(now) for c in active]
+        return result
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """Endpoint HTTP locale: GET / per i contatori, GET /connections anche per connessione"""
+
+    proxy = None
+
+    def do_GET(self):
+        if self.path not in ("/", "/connections"):
+            return self.send_error(404, "Not found")
+        data = json.dumps(self.proxy.snapshot(connections=self.path == "/connections"), indent=2).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        log.debug("[stats] " + format, *args)
+
+
+class Backend:
+    """Server remoto verso cui il proxy inoltra le connessioni"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.healthy = True
+        self.active = 0
+        # Connessioni già stabilite pronte per nuovi client
+        self.idle = collections.deque()
+
+    def __str__(self):
+        return f"{self.host}:{self.port}"
+
+    def snapshot(self):
+        return {"backend": str(self), "healthy": self.healthy, "active": self.active,
+                "pooled": len(self.idle)}
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        return socket.create_connection((self.host, self.port), timeout=timeout)
+
+    def take_pooled(self):
+        """Ritorna una connessione del pool ancora aperta, oppure None"""
+        while True:
+            try:
+                sock = self.idle.popleft()
+            except IndexError:
+                return None
+            # Scarta le connessioni chiuse dal server mentre erano nel pool
+            try:
+                if sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b"":
+                    sock.close()
+                    continue
+            except BlockingIOError:
+                pass
+            except OSError:
+                sock.close()
+                continue
+            return sock
+
+
+class BackendGroup:
+    """Insieme di backend con bilanciamento, health check e pool di connessioni"""
+
+    STRATEGIES = ("roundrobin", "leastconn", "hash")
+
+    def __init__(self, backends, strategy="roundrobin", health_interval=0, pool_size=0):
+        self.backends = [Backend(host, port) for host, port in backends]
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.next_index = 0
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.ring = []
+        for backend in self.backends:
+            for i in range(HASH_REPLICAS):
+                self.ring.append((self.hash_key(f"{backend}#{i}"), backend))
+        self.ring.sort(key=lambda item: item[0])
+        self.ring_keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def hash_key(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+    def choose(self, client_ip, exclude=()):
+        """Sceglie il backend per un client, saltando quelli in exclude.
+
+        Se nessun backend risulta sano si prova comunque tra tutti, per non
+        bloccare il traffico a causa di un health check che fallisce per errore.
+        """
+        with self.lock:
+            candidates = [b for b in self.backends if b.healthy and b not in exclude]
+            if not candidates:
+                candidates = [b for b in self.backends if b not in exclude]
+            if not candidates:
+                return None
+            if self.strategy == "leastconn":
+                backend = min(candidates, key=lambda b: b.active)
+            elif self.strategy == "hash":
+                index = bisect.bisect(self.ring_keys, self.hash_key(client_ip))
+                for offset in range(len(self.ring)):
+                    backend = self.ring[(index + offset) % len(self.ring)][1]
+                    if backend in candidates:
+                        break
+            else:
+                backend = candidates[self.next_index % len(candidates)]
+                self.next_index += 1
+            backend.active += 1
+            return backend
+
+    def release(self, backend):
+        with self.lock:
+            backend.active -= 1
+
+    def take_pooled(self, backend):
+        sock = backend.take_pooled()
+        if sock is not None:
+            # Ripristina il pool in background
+            self.wakeup.set()
+        return sock
+
+    def report_failure(self, backend, error):
+        """Segnala una connessione fallita; il backend viene escluso fino al prossimo check riuscito"""
+        log.warning("[!] Connessione a %s fallita: %s", backend, error)
+        if self.health_interval and backend.healthy:
+            backend.healthy = False
+            log.warning("[!] Backend %s escluso", backend)
+
+    def start(self):
+        """Avvia il thread di health check e mantenimento del pool"""
+        if not self.health_interval and not self.pool_size:
+            return
+        thread = threading.Thread(target=self.maintain)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Ferma il thread di mantenimento e chiude le connessioni del pool"""
+        self.stopped = True
+        self.wakeup.set()
+        for backend in self.backends:
+            while backend.idle:
+                backend.idle.popleft().close()
+
+    def maintain(self):
+        while not self.stopped:
+            for backend in self.backends:
+                if self.health_interval:
+                    self.check(backend)
+                if backend.healthy:
+                    self.fill_pool(backend)
+            self.wakeup.wait(self.health_interval or HEALTH_INTERVAL)
+            self.wakeup.clear()
+
+    def check(self, backend):
+        try:
+            backend.connect().close()
+        except OSError as e:
+            if backend.healthy:
+                backend.healthy = False
+                log.warning("[!] Backend %s escluso: %s", backend, e)
+            return
+        if not backend.healthy:
+            backend.healthy = True
+            log.warning("[*] Backend %s di nuovo disponibile", backend)
+
+    def fill_pool(self, backend):
+        while len(backend.idle) < self.pool_size and not self.stopped:
+            try:
+                sock = backend.connect()
+            except OSError:
+                return
+            sock.settimeout(None)
+            backend.idle.append(sock)
+
+
+class RelayConnection:
+    """Coppia di socket client/server gestita dall'event loop"""
+
+    def __init__(self, relay, proxy, client_socket, addr):
+        self.relay = relay
+        self.proxy = proxy
+        self.client = client_socket
+        self.addr = addr
+        self.remote = None
+        self.backend = None
+        self.tried = set()
+        self.connecting = True
+        self.connect_started = None
+        self.closed = False
+        self.stats = None
+        # Dati letti da un lato e non ancora scritti sull'altro
+        self.to_remote = bytearray()
+        self.to_client = bytearray()
+        self.client_eof = False
+        self.remote_eof = False
+        # Lettura sospesa perché il buffer verso l'altro lato ha superato l'high watermark
+        self.client_paused = False
+        self.remote_paused = False
+        # Token bucket del client e della porta; throttled sospende entrambi i versi
+        self.buckets = []
+        self.throttled = False
+        self.last_activity = time.monotonic()
+        self.events = {}
+
+    def open(self):
+        """Registra il client e avvia la connessione verso un backend"""
+        log.info("[*] Connessione ricevuta da %s:%s", *self.addr[:2])
+        self.stats = self.proxy.stats.open(self.addr)
+        self.buckets = self.proxy.acquire_buckets(self.addr[0])
+        self.relay.connections.add(self)
+        self.client.setblocking(False)
+        self.connect_upstream()
+
+    def connect_upstream(self):
+        """Usa una connessione del pool o avvia un connect non bloccante verso un backend"""
+        backends = self.proxy.backends
+        while True:
+            self.backend = backends.choose(self.addr[0], exclude=self.tried)
+            if self.backend is None:
+                log.warning("[!] Nessun backend disponibile per %s:%s", *self.addr[:2])
+                return self.close()
+            self.tried.add(self.backend)
+            self.connect_started = time.monotonic()
+            self.remote = backends.take_pooled(self.backend)
+            if self.remote is not None:
+                self.remote.setblocking(False)
+                self.connecting = False
+                self.proxy.stats.connected(self.stats, self.backend, time.monotonic() - self.connect_started)
+                log.debug("[*] Connessione dal pool verso %s", self.backend)
+                return self.update_interest()
+            self.connecting = True
+            self.remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.remote.setblocking(False)
+            err = self.remote.connect_ex((self.backend.host, self.backend.port))
+            if err in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                return self.update_interest()
+            self.drop_upstream(OSError(err, errno.errorcode.get(err, str(err))))
+
+    def drop_upstream(self, error):
+        """Chiude il tentativo di connessione fallito verso il backend corrente"""
+        self.proxy.backends.report_failure(self.backend, error)
+        self.proxy.backends.release(self.backend)
+        self.proxy.stats.connect_failed()
+        self.backend = None
+        self.set_events(self.remote, 0)
+        self.events.pop(self.remote, None)
+        self.remote.close()
+        self.remote = None
+
+    def check_timeouts(self, now):
+        """Chiamata periodicamente dal relay: connect troppo lento o connessione inattiva"""
+        if self.connecting:
+            if now - self.connect_started >= self.proxy.connect_timeout:
+                self.drop_upstream(TimeoutError("timeout di connessione"))
+                self.connect_upstream()
+        elif self.proxy.idle_timeout and now - self.last_activity >= self.proxy.idle_timeout:
+            log.info("[*] Connessione inattiva da %ss con %s:%s", self.proxy.idle_timeout, *self.addr[:2])
+            self.close()
+
+    def on_event(self, sock, mask):
+        """Gestisce un evento di lettura/scrittura su uno dei due socket"""
+        self.last_activity = time.monotonic()
+        try:
+            if self.connecting:
+                err = self.remote.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    # Riprova sugli altri backend
+                    self.drop_upstream(OSError(err, errno.errorcode.get(err, str(err))))
+                    return self.connect_upstream()
+                self.connecting = False
+                self.proxy.stats.connected(self.stats, self.backend, time.monotonic() - self.connect_started)
+                log.debug("[*] Connesso al server remoto %s", self.backend)
+            elif sock is self.client:
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(self.client, self.to_client)
+                if mask & selectors.EVENT_READ and not self.throttled:
+                    n = self.pump(self.client, self.remote, self.to_remote)
+                    self.stats.client_to_server += n
+                    self.client_eof = not n
+            else:
+                if mask & selectors.EVENT_WRITE:
+                    self.flush(self.remote, self.to_remote)
+                if mask & selectors.EVENT_READ and not self.throttled:
+                    n = self.pump(self.remote, self.client, self.to_client)
+                    self.stats.server_to_client += n
+                    self.remote_eof = not n
+        except OSError as e:
+            log.warning("[!] Errore nella gestione della connessione: %s", e)
+            return self.close()
+
+        # Propaga la chiusura in scrittura quando il buffer verso il lato opposto è vuoto
+        if self.client_eof and not self.to_remote:
+            self.shutdown_write(self.remote)
+        if self.remote_eof and not self.to_client:
+            self.shutdown_write(self.client)
+        if self.client_eof and self.remote_eof and not self.to_remote and not self.to_client:
+            return self.close()
+        self.update_interest()
+
+    def pump(self, src, dst, pending):
+        """Legge da src e scrive su dst; ritorna i byte letti (0 se src ha chiuso)"""
+        limit = 0
+        if self.buckets:
+            # Non leggere più di quanto i token bucket consentono
+            limit = max(1, min(int(min(b.available() for b in self.buckets)), len(self.relay.buffer)))
+        # Il buffer di lettura è condiviso da tutte le connessioni del loop:
+        # solo la parte non ancora inviata viene copiata in pending
+        n = src.recv_into(self.relay.buffer, limit)
+        if not n:
+            return 0
+        data = self.relay.view[:n]
+        if self.buckets:
+            delay = max(b.consume(n) for b in self.buckets)
+            if delay:
+                self.throttled = True
+                self.relay.call_later(delay, self.unthrottle)
+        if pending:
+            # Mantieni l'ordine: i nuovi dati vanno in coda a quelli in attesa
+            pending += data
+            return n
+        try:
+            sent = dst.send(data)
+        except BlockingIOError:
+            sent = 0
+        if sent < n:
+            pending += data[sent:]
+        return n
+
+    def unthrottle(self):
+        self.throttled = False
+        if not self.closed:
+            self.update_interest()
+
+    def flush(self, sock, pending):
+        """Scrive su sock i dati rimasti in attesa"""
+        try:
+            sent = sock.send(pending)
+        except BlockingIOError:
+            return
+        del pending[:sent]
+
+    def shutdown_write(self, sock):
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    def update_interest(self):
+        """Aggiorna gli eventi registrati nel selector per entrambi i socket"""
+        if self.connecting:
+            self.set_events(self.client, 0)
+            self.set_events(self.remote, selectors.EVENT_WRITE)
+            return
+        # Isteresi tra high e low watermark per non alternare pausa e ripresa a ogni chunk
+        high, low = self.proxy.high_watermark, self.proxy.low_watermark
+        if self.client_paused:
+            self.client_paused = len(self.to_remote) > low
+        else:
+            self.client_paused = len(self.to_remote) >= high
+        if self.remote_paused:
+            self.remote_paused = len(self.to_client) > low
+        else:
+            self.remote_paused = len(self.to_client) >= high
+        client_events = 0
+        if not self.client_eof and not self.client_paused and not self.throttled:
+            client_events |= selectors.EVENT_READ
+        if self.to_client:
+            client_events |= selectors.EVENT_WRITE
+        remote_events = 0
+        if not self.remote_eof and not self.remote_paused and not self.throttled:
+            remote_events |= selectors.EVENT_READ
+        if self.to_remote:
+            remote_events |= selectors.EVENT_WRITE
+        self.set_events(self.client, client_events)
+        self.set_events(self.remote, remote_events)
+
+    def set_events(self, sock, events):
+        current = self.events.get(sock, 0)
+        if events == current:
+            return
+        selector = self.relay.selector
+        if not current:
+            selector.register(sock, events, self)
+        elif not events:
+            selector.unregister(sock)
+        else:
+            selector.modify(sock, events, self)
+        self.events[sock] = events
+
+    def close(self):
+        """Chiude entrambi i socket e li rimuove dal selector"""
+        if self.closed:
+            return
+        self.closed = True
+        for sock in (self.client, self.remote):
+            if sock is None:
+                continue
+            if self.events.get(sock):
+                self.relay.selector.unregister(sock)
+            sock.close()
+        self.events.clear()
+        if self.backend is not None:
+            self.proxy.backends.release(self.backend)
+        self.proxy.release_buckets(self.addr[0])
+        self.proxy.stats.close(self.stats)
+        self.relay.connections.discard(self)
+        log.info("[*] Connessione chiusa con %s:%s", *self.addr[:2])
+
+
+class SelectRelay:
+    """Event loop a singolo thread che multiplexa tutte le connessioni del proxy"""
+
+    def __init__(self, buffer_size=BUFFER_SIZE):
+        self.selector = selectors.DefaultSelector()
+        self.running = False
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.connections = set()
+        self.listeners = {}
+        self.drain_deadline = None
+        # Funzioni da eseguire nel thread del loop (es. richieste da signal handler)
+        self.pending_calls = collections.deque()
+        # Heap di (scadenza, sequenza, callback)
+        self.timers = []
+        self.timer_seq = 0
+        self.call_later(1.0, self.check_timeouts)
+
+    def add_listener(self, server_socket, proxy):
+        """Registra un socket in ascolto i cui client vengono inoltrati da proxy"""
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, proxy)
+        self.listeners[server_socket] = proxy
+
+    def replace_listener(self, server_socket, proxy):
+        """Inoltra i nuovi client di server_socket a proxy; le connessioni aperte non cambiano"""
+        self.selector.modify(server_socket, selectors.EVENT_READ, proxy)
+        self.listeners[server_socket] = proxy
+
+    def remove_listener(self, server_socket):
+        """Chiude un socket in ascolto lasciando attive le connessioni già accettate"""
+        self.selector.unregister(server_socket)
+        del self.listeners[server_socket]
+        server_socket.close()
+
+    def call_soon(self, callback):
+        """Esegue callback alla prossima iterazione del loop; sicura da un signal handler"""
+        self.pending_calls.append(callback)
+
+    def call_later(self, delay, callback):
+        """Esegue callback nel thread del loop dopo delay secondi"""
+        self.timer_seq += 1
+        heapq.heappush(self.timers, (time.monotonic() + delay, self.timer_seq, callback))
+
+    def run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            heapq.heappop(self.timers)[2]()
+
+    def check_timeouts(self):
+        now = time.monotonic()
+        for connection in list(self.connections):
+            if not connection.closed:
+                connection.check_timeouts(now)
+        self.call_later(1.0, self.check_timeouts)
+
+    def accept(self, server_socket, proxy):
+        while True:
+            try:
+                client_socket, addr = server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log.error("[!] Errore in accept: %s", e)
+                return
+            RelayConnection(self, proxy, client_socket, addr).open()
+
+    def run(self):
+        """Esegue il loop finché stop() non viene chiamato o il drain non termina"""
+        self.running = True
+        try:
+            while self.running:
+                while self.pending_calls:
+                    self.pending_calls.popleft()()
+                if self.drain_deadline is not None:
+                    if self.listeners:
+                        self.close_listeners()
+                        print(f"[*] Accept chiuso, attendo {len(self.connections)} connessioni attive...")
+                    if not self.connections or time.monotonic() >= self.drain_deadline:
+                        break
+                timeout = 1.0
+                if self.timers:
+                    timeout = min(timeout, max(0, self.timers[0][0] - time.monotonic()))
+                for key, mask in self.selector.select(timeout=timeout):
+                    if isinstance(key.data, RelayConnection):
+                        if not key.data.closed:
+                            key.data.on_event(key.fileobj, mask)
+                    else:
+                        self.accept(key.fileobj, key.data)
+                self.run_timers()
+        finally:
+            self.close()
+
+    def stop(self):
+        self.running = False
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Smette di accettare e attende al massimo timeout secondi le connessioni attive.
+
+        Imposta solo un attributo: può essere chiamata da un signal handler.
+        """
+        self.drain_deadline = time.monotonic() + timeout
+
+    def close_listeners(self):
+        for server_socket in list(self.listeners):
+            self.remove_listener(server_socket)
+
+    def close(self):
+        """Chiude i socket in ascolto e tutte le connessioni ancora aperte"""
+        self.close_listeners()
+        for connection in list(self.connections):
+            connection.close()
+        self.selector.close()
+
 
 class TCPProxy:
-    def __init__(self, local_port, remote_host, remote_port):
+    def __init__(self, local_port, remote_host, remote_port, mode="select",
+                 buffer_size=BUFFER_SIZE, splice=True, backlog=socket.SOMAXCONN,
+                 reuse_port=False, drain_timeout=DRAIN_TIMEOUT, backends=(),
+                 balance="roundrobin", health_interval=0, pool_size=0, stats_port=None,
+                 high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK,
+                 rate_limit_client=None, rate_limit_listener=None, idle_timeout=None,
+                 connect_timeout=CONNECT_TIMEOUT):
         self.local_port = local_port
         self.remote_host = remote_host
         self.remote_port = remote_port
+        self.backends = BackendGroup([(remote_host, remote_port), *backends], strategy=balance,
+                                     health_interval=health_interval, pool_size=pool_size)
+        self.mode = mode
+        self.buffer_size = buffer_size
+        self.splice = splice and SPLICE_AVAILABLE
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self.rate_limit_client = rate_limit_client
+        self.listener_bucket = TokenBucket(rate_limit_listener) if rate_limit_listener else None
+        # IP del client -> [TokenBucket, connessioni che lo usano]
+        self.client_buckets = {}
+        self.buckets_lock = threading.Lock()
+        self.stats = ProxyStats()
+        self.stats_port = stats_port
+        # Con più worker ciascuno espone le statistiche su stats_port + indice
+        self.worker_index = 0
         self.server = None
-        
+        self.relay = None
+        self.stopping = False
+        self.active = 0
+        self.active_lock = threading.Lock()
+
+    def acquire_buckets(self, client_ip):
+        """Token bucket da applicare a una nuova connessione del client"""
+        buckets = []
+        if self.listener_bucket is not None:
+            buckets.append(self.listener_bucket)
+        if self.rate_limit_client:
+            with self.buckets_lock:
+                entry = self.client_buckets.get(client_ip)
+                if entry is None:
+                    entry = self.client_buckets[client_ip] = [TokenBucket(self.rate_limit_client), 0]
+                entry[1] += 1
+                buckets.append(entry[0])
+        return buckets
+
+    def release_buckets(self, client_ip):
+        if not self.rate_limit_client:
+            return
+        with self.buckets_lock:
+            entry = self.client_buckets.get(client_ip)
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.client_buckets[client_ip]
+
+    def forward(self, src, dst, direction, count, buckets=(), still_active=None):
+        """Inoltra src -> dst fino alla chiusura di src (modalità threaded)"""
+        if buckets:
+            def count(n, account=count):
+                account(n)
+                delay = max(b.consume(n) for b in buckets)
+                if delay:
+                    time.sleep(delay)
+        try:
+            # Con l'idle timeout i socket hanno un timeout, incompatibile con splice bloccante
+            if self.splice and not self.idle_timeout:
+                try:
+                    relay_splice(src, dst, self.buffer_size, count)
+                    return dst.shutdown(socket.SHUT_WR)
+                except OSError as e:
+                    # splice non supportato su questa coppia di socket
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+            relay_buffered(src, dst, self.buffer_size, count, still_active)
+            # Propaga la chiusura lasciando aperto l'altro verso
+            dst.shutdown(socket.SHUT_WR)
+        except Exception as e:
+            log.warning("[!] Errore %s: %s", direction, e)
+            src.close()
+            dst.close()
+
     def handle_client(self, client_socket, addr):
         """Gestisce la connessione di un singolo client"""
-        print(f"[*] Connessione ricevuta da {addr[0]}:{addr[1]}")
-        
+        log.info("[*] Connessione ricevuta da %s:%s", *addr[:2])
+        stats = self.stats.open(addr)
+        buckets = self.acquire_buckets(addr[0])
+        with self.active_lock:
+            self.active += 1
+
+        backend = None
         try:
-            # Connessione al server remoto
-            remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            remote_socket.connect((self.remote_host, self.remote_port))
-            print(f"[*] Connesso al server remoto {self.remote_host}:{self.remote_port}")
-            
-            # Thread per inoltrare dati client -> server
-            def forward_client_to_server():
-                try:
-                    while True:
-                        data = client_socket.recv(4096)
-                        if not data:
-                            break
-                        remote_socket.sendall(data)
-                        print(f"[->] Inoltrati {len(data)} bytes al server remoto")
-                except Exception as e:
-                    print(f"[!] Errore client->server: {e}")
-                finally:
-                    remote_socket.close()
-                    client_socket.close()
-            
-            # Thread per inoltrare dati server -> client
-            def forward_server_to_client():
+            # Connessione al server remoto (dal pool o nuova), provando tutti i backend
+            tried = set()
+            while True:
+                backend = self.backends.choose(addr[0], exclude=tried)
+                if backend is None:
+                    raise ConnectionError("nessun backend disponibile")
+                tried.add(backend)
+                connect_started = time.monotonic()
+                remote_socket = self.backends.take_pooled(backend)
+                if remote_socket is not None:
+                    remote_socket.setblocking(True)
+                    break
                 try:
-                    while True:
-                        data = remote_socket.recv(4096)
-                        if not data:
-                            break
-                        client_socket.sendall(data)
-                        print(f"[<-] Inoltrati {len(data)} bytes al client")
-                except Exception as e:
-                    print(f"[!] Errore server->client: {e}")
-                finally:
+                    remote_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    remote_socket.settimeout(self.connect_timeout)
+                    remote_socket.connect((backend.host, backend.port))
+                    break
+                except OSError as e:
                     remote_socket.close()
-                    client_socket.close()
-            
+                    self.backends.report_failure(backend, e)
+                    self.backends.release(backend)
+                    self.stats.connect_failed()
+                    backend = None
+            self.stats.connected(stats, backend, time.monotonic() - connect_started)
+            log.debug("[*] Connesso al server remoto %s", backend)
+
+            still_active = None
+            if self.idle_timeout:
+                # Un verso fermo non chiude la connessione se l'altro sta ancora trasferendo
+                def still_active():
+                    return time.monotonic() - stats.last_activity < self.idle_timeout
+            client_socket.settimeout(self.idle_timeout)
+            remote_socket.settimeout(self.idle_timeout)
+
             # Avvia i thread di inoltro
-            thread_c2s = threading.Thread(target=forward_client_to_server)
-            thread_s2c = threading.Thread(target=forward_server_to_client)
+            thread_c2s = threading.Thread(
+                target=self.forward,
+                args=(client_socket, remote_socket, "client->server", stats.add_client_to_server,
+                      buckets, still_active)
+            )
+            thread_s2c = threading.Thread(
+                target=self.forward,
+                args=(remote_socket, client_socket, "server->client", stats.add_server_to_client,
+                      buckets, still_active)
+            )
             thread_c2s.daemon = True
             thread_s2c.daemon = True
             thread_c2s.start()
             thread_s2c.start()
-            
+
             # Attendi che entrambi i thread terminino
             thread_c2s.join()
             thread_s2c.join()
-            
+            remote_socket.close()
+
         except Exception as e:
-            print(f"[!] Errore nella gestione della connessione: {e}")
+            log.warning("[!] Errore nella gestione della connessione: %s", e)
         finally:
             client_socket.close()
-            print(f"[*] Connessione chiusa con {addr[0]}:{addr[1]}")
-    
+            if backend is not None:
+                self.backends.release(backend)
+            self.release_buckets(addr[0])
+            self.stats.close(stats)
+            with self.active_lock:
+                self.active -= 1
+            log.info("[*] Connessione chiusa con %s:%s", *addr[:2])
+
+    def serve_threaded(self):
+        """Accetta i client e li gestisce ciascuno in un thread separato"""
+        # Il timeout permette di controllare periodicamente la richiesta di stop
+        self.server.settimeout(1.0)
+        while not self.stopping:
+            try:
+                client_socket, addr = self.server.accept()
+            except socket.timeout:
+                continue
+            # Gestisci ogni client in un thread separato
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, addr)
+            )
+            client_thread.daemon = True
+            client_thread.start()
+
+        # Drain: niente più accept, attendi i thread ancora attivi
+        self.server.close()
+        print(f"[*] Accept chiuso, attendo {self.active} connessioni attive...")
+        deadline = time.monotonic() + self.drain_timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.2)
+
+    def serve_select(self):
+        """Gestisce tutti i client in un unico thread tramite SelectRelay"""
+        self.relay = SelectRelay(self.buffer_size)
+        self.relay.add_listener(self.server, self)
+        if self.stopping:
+            self.relay.drain(self.drain_timeout)
+        self.relay.run()
+
+    def snapshot(self, connections=False):
+        """Statistiche del proxy e dei backend in forma serializzabile in JSON"""
+        result = {"pid": os.getpid(), "port": self.local_port, "mode": self.mode}
+        result.update(self.stats.snapshot(connections))
+        result["backends"] = [backend.snapshot() for backend in self.backends.backends]
+        return result
+
+    def dump_stats(self, signum=None, frame=None):
+        """Handler di SIGUSR1: stampa le statistiche su stderr"""
+        print(json.dumps(self.snapshot(), indent=2), file=sys.stderr, flush=True)
+
+    def stop(self, signum=None, frame=None):
+        """Avvia lo spegnimento graduale; usabile come handler di SIGTERM"""
+        self.stopping = True
+        if self.relay is not None:
+            self.relay.drain(self.drain_timeout)
+
+    def create_server_socket(self):
+        """Crea il socket in ascolto, con SO_REUSEPORT se richiesto"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.bind(('0.0.0.0', self.local_port))
+        server.listen(self.backlog)
+        return server
+
+    def check_bind(self):
+        """Verifica che la porta sia disponibile"""
+        self.create_server_socket().close()
+
     def start(self):
         """Avvia il proxy TCP"""
+        signal.signal(signal.SIGTERM, self.stop)
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, self.dump_stats)
         try:
             # Crea il socket server
-            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server.bind(('0.0.0.0', self.local_port))
-            self.server.listen(5)
-            
-            print(f"[*] TCP Proxy avviato su porta {self.local_port}")
-            print(f"[*] Inoltra verso {self.remote_host}:{self.remote_port}")
+            self.server = self.create_server_socket()
+
+            print(f"[*] TCP Proxy avviato su porta {self.local_port} (modalità {self.mode}, pid {os.getpid()})")
+            if self.mode == "threaded":
+                print(f"[*] Copia dati: {'splice' if self.splice else 'recv_into'}, buffer {self.buffer_size} bytes")
+            print(f"[*] Inoltra verso {', '.join(map(str, self.backends.backends))} ({self.backends.strategy})")
+            self.backends.start()
+            if self.stats_port:
+                start_stats_server(self, self.stats_port + self.worker_index)
             print("[*] In attesa di connessioni... (Ctrl+C per terminare)")
-            
-            while True:
-                client_socket, addr = self.server.accept()
-                # Gestisci ogni client in un thread separato
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, addr)
-                )
-                client_thread.daemon = True
-                client_thread.start()
-                
+
+            if self.mode == "threaded":
+                self.serve_threaded()
+            else:
+                self.serve_select()
+
         except KeyboardInterrupt:
             print("\n[*] Interruzione ricevuta, chiusura del proxy...")
         except Exception as e:
@@ -105,26 +1139,341 @@ class TCPProxy:
         finally:
             if self.server:
                 self.server.close()
+            self.backends.stop()
+            print("[*] Proxy terminato")
+
+
+class ProxyServer:
+    """Più route (porta locale -> backend) servite da un processo e un solo SelectRelay.
+
+    Le route sono lette da un file di configurazione e ricaricate su SIGHUP:
+    le porte nuove vengono aperte, quelle rimosse chiuse e quelle modificate
+    passano ai nuovi backend, mentre le connessioni già aperte proseguono
+    con la route con cui sono state accettate.
+    """
+
+    def __init__(self, config_path, buffer_size=BUFFER_SIZE, backlog=socket.SOMAXCONN,
+                 reuse_port=False, drain_timeout=DRAIN_TIMEOUT, stats_port=None,
+                 high_watermark=HIGH_WATERMARK, low_watermark=LOW_WATERMARK):
+        self.config_path = config_path
+        self.buffer_size = buffer_size
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.backlog = backlog
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.stats_port = stats_port
+        self.worker_index = 0
+        # porta locale -> (opzioni della route, TCPProxy)
+        self.routes = {}
+        self.relay = None
+        self.stopping = False
+
+    def build_route(self, port, options):
+        (host, remote_port), *others = options["backends"]
+        return TCPProxy(port, host, remote_port, buffer_size=self.buffer_size,
+                        backlog=self.backlog, reuse_port=self.reuse_port,
+                        drain_timeout=self.drain_timeout, backends=others,
+                        balance=options["balance"], health_interval=options["health_interval"],
+                        pool_size=options["pool_size"], high_watermark=self.high_watermark,
+                        low_watermark=self.low_watermark,
+                        rate_limit_client=options["rate_limit_client"],
+                        rate_limit_listener=options["rate_limit_listener"],
+                        idle_timeout=options["idle_timeout"],
+                        connect_timeout=options["connect_timeout"])
+
+    def apply(self, routes):
+        """Porta le route attive allo stato descritto da routes"""
+        for port in list(self.routes):
+            if port not in routes:
+                _, proxy = self.routes.pop(port)
+                self.relay.remove_listener(proxy.server)
+                proxy.backends.stop()
+                print(f"[*] Route {port} rimossa")
+
+        for port, options in routes.items():
+            current = self.routes.get(port)
+            if current is not None and current[0] == options:
+                continue
+            proxy = self.build_route(port, options)
+            if current is None:
+                try:
+                    proxy.server = proxy.create_server_socket()
+                except OSError as e:
+                    print(f"[!] Impossibile aprire la porta {port}: {e}")
+                    continue
+                self.relay.add_listener(proxy.server, proxy)
+                action = "aggiunta"
+            else:
+                # Stesso socket in ascolto, nuovi backend; le statistiche proseguono
+                old = current[1]
+                proxy.server = old.server
+                proxy.stats = old.stats
+                self.relay.replace_listener(proxy.server, proxy)
+                old.backends.stop()
+                action = "aggiornata"
+            proxy.backends.start()
+            self.routes[port] = (options, proxy)
+            backends = ", ".join(map(str, proxy.backends.backends))
+            print(f"[*] Route {port} {action}: inoltra verso {backends} ({proxy.backends.strategy})")
+
+    def reload(self):
+        try:
+            routes = load_routes(self.config_path)
+        except (OSError, ValueError) as e:
+            print(f"[!] Ricaricamento di {self.config_path} fallito, configurazione invariata: {e}")
+            return
+        print(f"[*] Ricaricamento di {self.config_path}")
+        self.apply(routes)
+
+    def request_reload(self, signum=None, frame=None):
+        """Handler di SIGHUP: il ricaricamento avviene nel thread del loop"""
+        if self.relay is not None:
+            self.relay.call_soon(self.reload)
+
+    def check_bind(self):
+        """Verifica che tutte le porte della configurazione siano disponibili"""
+        for port, options in load_routes(self.config_path).items():
+            self.build_route(port, options).check_bind()
+
+    def snapshot(self, connections=False):
+        return {"pid": os.getpid(),
+                "routes": [proxy.snapshot(connections) for _, proxy in self.routes.values()]}
+
+    def dump_stats(self, signum=None, frame=None):
+        print(json.dumps(self.snapshot(), indent=2), file=sys.stderr, flush=True)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        if self.relay is not None:
+            self.relay.drain(self.drain_timeout)
+
+    def start(self):
+        """Avvia tutte le route della configurazione nello stesso event loop"""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGHUP, self.request_reload)
+        signal.signal(signal.SIGUSR1, self.dump_stats)
+        try:
+            routes = load_routes(self.config_path)
+            self.relay = SelectRelay(self.buffer_size)
+            print(f"[*] TCP Proxy avviato da {self.config_path} (pid {os.getpid()})")
+            self.apply(routes)
+            if self.stats_port:
+                start_stats_server(self, self.stats_port + self.worker_index)
+            print("[*] In attesa di connessioni... (SIGHUP per ricaricare, Ctrl+C per terminare)")
+            if self.stopping:
+                self.relay.drain(self.drain_timeout)
+            self.relay.run()
+
+        except KeyboardInterrupt:
+            print("\n[*] Interruzione ricevuta, chiusura del proxy...")
+        except Exception as e:
+            print(f"[!] Errore: {e}")
+        finally:
+            for _, proxy in self.routes.values():
+                proxy.backends.stop()
             print("[*] Proxy terminato")
 
+
+class WorkerSupervisor:
+    """Avvia N processi worker sulla stessa porta e li riavvia se terminano"""
+
+    def __init__(self, proxy, workers):
+        self.proxy = proxy
+        self.count = workers
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            # Processo worker: ripristina i segnali e serve le connessioni
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            self.proxy.worker_index = index
+            code = 0
+            try:
+                self.proxy.start()
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        self.workers[pid] = (index, time.monotonic())
+        print(f"[*] Worker {pid} avviato")
+
+    def stop(self, signum=None, frame=None):
+        """Inoltra SIGTERM ai worker, che chiudono l'accept e completano le connessioni"""
+        if self.stopping:
+            return
+        self.stopping = True
+        print(f"\n[*] Arresto: drain di {len(self.workers)} worker (max {self.proxy.drain_timeout}s)...")
+        self.signal_workers(signal.SIGTERM)
+
+    def signal_workers(self, signum):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def forward_signal(self, signum, frame=None):
+        """Inoltra SIGUSR1 (statistiche) e SIGHUP (ricaricamento) ai worker"""
+        self.signal_workers(signum)
+
+    def run(self):
+        # Verifica subito che le porte siano disponibili invece di far fallire ogni worker
+        self.proxy.check_bind()
+        print(f"[*] Supervisor {os.getpid()}: {self.count} worker "
+              f"(SO_REUSEPORT, backlog {self.proxy.backlog})")
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGUSR1, self.forward_signal)
+        signal.signal(signal.SIGHUP, self.forward_signal)
+        for index in range(self.count):
+            self.spawn(index)
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            worker = self.workers.pop(pid, None)
+            if worker is None or self.stopping:
+                continue
+            index, started = worker
+            print(f"[!] Worker {pid} terminato (stato {os.waitstatus_to_exitcode(status)}), riavvio...")
+            # Evita un ciclo di fork se il worker muore subito dopo l'avvio
+            if time.monotonic() - started < 1:
+                time.sleep(1)
+            if not self.stopping:
+                self.spawn(index)
+        print("[*] Supervisor terminato")
+
 def main():
-    if len(sys.argv) != 4:
-        print("Uso: python tcp-proxy.py <local_port> <remote_host> <remote_port>")
-        print("Esempio: python tcp-proxy.py 8080 192.168.1.100 80")
-        sys.exit(1)
-    
+    parser = argparse.ArgumentParser(
+        description="TCP Proxy - Inoltra connessioni TCP da una porta locale verso un server remoto",
+        epilog="Esempio: python tcp-proxy.py 8080 192.168.1.100 80",
+    )
+    parser.add_argument("local_port", nargs="?", help="porta locale in ascolto")
+    parser.add_argument("remote_host", nargs="?", help="host del server remoto")
+    parser.add_argument("remote_port", nargs="?", help="porta del server remoto")
+    parser.add_argument("--config", metavar="FILE",
+                        help="file TOML/JSON con più route (sostituisce gli argomenti posizionali)")
+    parser.add_argument("--mode", choices=("select", "threaded"), default="select",
+                        help="select: un thread per tutte le connessioni (default); "
+                             "threaded: tre thread per connessione")
+    parser.add_argument("--buffer-size", type=int, default=BUFFER_SIZE,
+                        help=f"dimensione del buffer di inoltro in byte (default {BUFFER_SIZE})")
+    parser.add_argument("--no-splice", action="store_true",
+                        help="in modalità threaded usa recv_into invece di os.splice")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="numero di processi worker con SO_REUSEPORT (default 1)")
+    parser.add_argument("--backlog", type=int, default=socket.SOMAXCONN,
+                        help=f"coda di accept del socket in ascolto (default {socket.SOMAXCONN})")
+    parser.add_argument("--drain-timeout", type=float, default=DRAIN_TIMEOUT,
+                        help=f"secondi di attesa delle connessioni attive su SIGTERM (default {DRAIN_TIMEOUT})")
+    parser.add_argument("--backend", action="append", default=[], metavar="HOST:PORT",
+                        help="backend aggiuntivo (ripetibile)")
+    parser.add_argument("--balance", choices=BackendGroup.STRATEGIES, default="roundrobin",
+                        help="strategia di bilanciamento tra i backend (default roundrobin)")
+    parser.add_argument("--health-interval", type=float, default=None,
+                        help=f"secondi tra gli health check, 0 per disattivarli "
+                             f"(default {HEALTH_INTERVAL} con più backend, altrimenti 0)")
+    parser.add_argument("--pool", type=int, default=0,
+                        help="connessioni pre-stabilite da tenere pronte per ogni backend (default 0)")
+    parser.add_argument("--high-watermark", type=parse_size, default=HIGH_WATERMARK,
+                        help=f"byte in attesa per verso oltre cui si smette di leggere (default {HIGH_WATERMARK})")
+    parser.add_argument("--low-watermark", type=parse_size, default=LOW_WATERMARK,
+                        help=f"byte in attesa sotto cui si riprende a leggere (default {LOW_WATERMARK})")
+    parser.add_argument("--rate-limit-client", type=parse_size, default=None, metavar="BYTES",
+                        help="byte/s massimi per IP del client, es. 512K o 10M (default illimitato)")
+    parser.add_argument("--rate-limit-listener", type=parse_size, default=None, metavar="BYTES",
+                        help="byte/s massimi per tutta la porta in ascolto (default illimitato)")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="secondi senza traffico dopo cui la connessione viene chiusa (default nessuno)")
+    parser.add_argument("--connect-timeout", type=float, default=CONNECT_TIMEOUT,
+                        help=f"secondi massimi per connettersi a un backend (default {CONNECT_TIMEOUT})")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="warning",
+                        help="info mostra ogni connessione, debug anche i backend scelti (default warning)")
+    parser.add_argument("--stats-port", type=int, default=None,
+                        help="porta locale (127.0.0.1) per le statistiche JSON; "
+                             "con più worker il worker i usa stats-port + i")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(message)s")
+
+    if args.config:
+        if args.local_port is not None:
+            parser.error("con --config non servono local_port, remote_host e remote_port")
+        if args.mode == "threaded":
+            parser.error("--config usa un unico event loop: --mode threaded non è supportato")
+    elif args.remote_port is None:
+        parser.error("servono local_port, remote_host e remote_port (oppure --config)")
+
     try:
-        local_port = int(sys.argv[1])
-        remote_host = sys.argv[2]
-        remote_port = int(sys.argv[3])
-        
+        if args.buffer_size < 1024:
+            print("[!] Il buffer deve essere di almeno 1024 bytes")
+            sys.exit(1)
+        if args.low_watermark >= args.high_watermark:
+            print("[!] --low-watermark deve essere minore di --high-watermark")
+            sys.exit(1)
+        if args.workers < 1:
+            print("[!] Il numero di worker deve essere almeno 1")
+            sys.exit(1)
+        if args.workers > 1 and not (hasattr(os, "fork") and hasattr(socket, "SO_REUSEPORT")):
+            print("[!] --workers richiede fork e SO_REUSEPORT (Linux/BSD)")
+            sys.exit(1)
+
+        if args.config:
+            # Valida subito la configurazione
+            try:
+                load_routes(args.config)
+            except (OSError, ValueError) as e:
+                print(f"[!] Configurazione non valida: {e}")
+                sys.exit(1)
+            proxy = ProxyServer(args.config, buffer_size=args.buffer_size, backlog=args.backlog,
+                                reuse_port=args.workers > 1, drain_timeout=args.drain_timeout,
+                                stats_port=args.stats_port, high_watermark=args.high_watermark,
+                                low_watermark=args.low_watermark)
+            if args.workers > 1:
+                WorkerSupervisor(proxy, args.workers).run()
+            else:
+                proxy.start()
+            return
+
+        local_port = int(args.local_port)
+        remote_host = args.remote_host
+        remote_port = int(args.remote_port)
+
         if not (1 <= local_port <= 65535) or not (1 <= remote_port <= 65535):
             print("[!] Le porte devono essere comprese tra 1 e 65535")
             sys.exit(1)
-        
-        proxy = TCPProxy(local_port, remote_host, remote_port)
-        proxy.start()
-        
+
+        backends = []
+        for spec in args.backend:
+            try:
+                backends.append(parse_backend(spec))
+            except ValueError as e:
+                print(f"[!] {e}")
+                sys.exit(1)
+        health_interval = args.health_interval
+        if health_interval is None:
+            health_interval = HEALTH_INTERVAL if backends else 0
+
+        proxy = TCPProxy(local_port, remote_host, remote_port, mode=args.mode,
+                         buffer_size=args.buffer_size, splice=not args.no_splice,
+                         backlog=args.backlog, reuse_port=args.workers > 1,
+                         drain_timeout=args.drain_timeout, backends=backends,
+                         balance=args.balance, health_interval=health_interval,
+                         pool_size=args.pool, stats_port=args.stats_port,
+                         high_watermark=args.high_watermark, low_watermark=args.low_watermark,
+                         rate_limit_client=args.rate_limit_client,
+                         rate_limit_listener=args.rate_limit_listener,
+                         idle_timeout=args.idle_timeout, connect_timeout=args.connect_timeout)
+        if args.workers > 1:
+            WorkerSupervisor(proxy, args.workers).run()
+        else:
+            proxy.start()
+
     except ValueError:
         print("[!] Errore: le porte devono essere numeri interi")
         sys.exit(1)
@@ -134,4 +1483,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-